@@ -2,32 +2,523 @@ import json
 from copy import deepcopy
 from datetime import datetime
 from ai_project.db import app
-from flask import jsonify, request
+from flask import Response, jsonify, request, stream_with_context
+from werkzeug.wsgi import wrap_file
 from ai_project.models.tasks import Tasks
 from ai_project.helpers.user import user_info
 from ai_project.helpers.auth import check_permission
-from ai_project.models.completions import Completions
-from ai_project.models.user_projects import UserProjects
-from ai_project.helpers.model_training import al_automatic_model_training
-from ai_project.utils.misc import logger
-from ai_project.helpers.projectai_project import (
-    Projectai_project,
-    project_is_visual_ner,
+from ai_project.models.completions import (
+    Completions,
+    OutputSchemaTuples,
+    ProjectRevisions,
+    UnknownResultItems,
+    VersionConflict,
+    label_configs,
+    parse_timestamp,
 )
+from ai_project.utils.misc import logger
+from ai_project.helpers.projectai_project import Projectai_project
 from ai_project.helpers.completions import (
+    ExportCache,
+    export_cache,
+    export_workers,
+    filter_copied_result,
+    get_export_changes,
+    import_tasks_stream,
+    iter_completions_json,
+    iter_export_shards,
+    project_metadata,
+    schedule_al_training,
+    task_acls,
+    stream_export,
+    stream_incremental_export,
+    stream_parallel_export,
     update_completions_meta_table,
     validate_completion_data,
+    write_completions_parquet,
+    write_export_archive,
 )
 
+EXPORT_MIMETYPES = {
+    "json": "application/json",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+COPY_DATA_TYPES = ("prediction", "completion")
+
+
+def clear_output_schema_if_changed(project_name, project_id):
+    """
+    Output schema tuples are maintained with every write; the derived
+    schema only needs recomputing when a tuple was added or removed
+    """
+    if OutputSchemaTuples.pop_changed(project_id):
+        Projectai_project.clear_derived_output_schema(project_name)
+
+
+def is_task_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def file_response(path, mimetype, filename=None, etag=None):
+    """
+    :param path: path of the file to send, or a file open for reading
+    """
+    file = open(path, "rb") if isinstance(path, str) else path
+    response = Response(
+        wrap_file(request.environ, file),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    if filename:
+        response.headers["Content-Disposition"] = (
+            f"attachment; filename={filename}"
+        )
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+def if_match_version():
+    """
+    Completion version the client last saw, from If-Match (None if absent)
+    """
+    for etag in request.if_match.as_set():
+        return int(etag) if etag.isdigit() else -1
+    return None
+
+
+def versioned_response(body, status, version):
+    response = jsonify(body)
+    response.status_code = status
+    response.set_etag(str(version))
+    return response
+
+
+@app.errorhandler(VersionConflict)
+def completion_version_conflict(error):
+    return (
+        jsonify(
+            {
+                "error": (
+                    f"Completion {error} was changed by someone else, "
+                    "reload it and retry"
+                )
+            }
+        ),
+        409,
+    )
+
+
+@app.errorhandler(UnknownResultItems)
+def unknown_result_items(error):
+    return (
+        jsonify(
+            {
+                "error": (
+                    "Changed result items not found in the completion: "
+                    + ", ".join(error.args[0])
+                )
+            }
+        ),
+        400,
+    )
+
 
 @app.route(
     "/api/projects/<string:project_name>/completions_ids", methods=["GET"]
 )
 def api_all_completion_ids(project_name: str):
-    """Get all completion ids"""
-    project = Projectai_project(name=project_name)
-    ids = project.get_completions_ids()
-    return jsonify(ids), 200
+    """
+    Get all completion ids. With after_id or limit, one page of them as
+    {"ids": [..], "next_after_id": ..}; with format=ranges, ids come as
+    [start, end] runs of consecutive ids. Revalidated with If-None-Match.
+    """
+    after_id = request.args.get("after_id", type=int)
+    limit = request.args.get("limit", type=int)
+    ranges = request.args.get("format") == "ranges"
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit should be positive"}), 400
+
+    project_id = project_metadata.get(project_name).project_id
+    revision = ProjectRevisions.read(project_id)
+    etag = None
+    if revision is not None:
+        etag = f"ids-{revision}-{after_id}-{limit}-{int(ranges)}"
+    if etag and etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    ids = Completions.get_completion_ids(project_id, after_id, limit, ranges)
+    body = ids
+    if after_id is not None or limit is not None:
+        if ranges:
+            count = sum(end - start + 1 for start, end in ids)
+            last_id = ids[-1][1] if ids else None
+        else:
+            count = len(ids)
+            last_id = ids[-1] if ids else None
+        # Only a full page may be followed by more ids
+        body = {
+            "ids": ids,
+            "next_after_id": last_id if count == limit else None,
+        }
+    response = jsonify(body)
+    if etag:
+        response.set_etag(etag)
+    return response
+
+
+@app.route(
+    "/api/projects/<string:project_name>/completions/export", methods=["GET"]
+)
+@check_permission("Manager")
+def api_export_completions(project_name: str):
+    """
+    Stream the project export as a JSON array, as JSON lines or as a
+    Parquet file of flattened result rows. Exports are cached per project
+    revision and revalidated with If-None-Match.
+    """
+    export_format = request.args.get("format", "json")
+    if export_format not in EXPORT_MIMETYPES:
+        return jsonify({"error": "Invalid export format"}), 400
+
+    project_id = project_metadata.get(project_name).project_id
+    export_args = (
+        project_id,
+        request.args.getlist("tags", type=int),
+        request.args.get("ground_truth") == "true",
+        request.args.get("exclude_tasks_without_completions") == "true",
+    )
+    workers = export_workers(request.args.get("workers", type=int))
+    archive = (
+        request.args.get("archive") == "true" and export_format != "parquet"
+    )
+
+    revision = ProjectRevisions.read(project_id)
+    cache_key = None
+    if revision is not None:
+        cache_key = ExportCache.key(
+            project_id,
+            revision,
+            *export_args[1:],
+            f"zip-{export_format}" if archive else export_format,
+        )
+    if cache_key and cache_key in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(cache_key)
+        return response
+
+    mimetype = EXPORT_MIMETYPES[export_format]
+    filename = None
+    if archive:
+        mimetype = "application/zip"
+        filename = f"{project_name}.zip"
+    elif export_format == "parquet":
+        filename = f"{project_name}.parquet"
+
+    cached_path = cache_key and export_cache.get(cache_key)
+    if cached_path:
+        return file_response(cached_path, mimetype, filename, cache_key)
+
+    if archive:
+        shards = iter_export_shards(
+            *export_args, export_format=export_format, workers=workers
+        )
+        path = export_cache.write(
+            cache_key,
+            lambda file: write_export_archive(shards, file, export_format),
+        )
+        return file_response(path, mimetype, filename, cache_key)
+
+    if export_format == "parquet":
+        records = iter_completions_json(*export_args)
+        try:
+            path = export_cache.write(
+                cache_key,
+                lambda file: write_completions_parquet(records, file),
+            )
+        except ImportError:
+            return (
+                jsonify({"error": "Parquet export requires pyarrow"}),
+                501,
+            )
+        return file_response(path, mimetype, filename, cache_key)
+
+    if workers:
+        chunks = stream_parallel_export(
+            iter_export_shards(
+                *export_args, export_format=export_format, workers=workers
+            ),
+            export_format,
+        )
+    else:
+        chunks = stream_export(
+            iter_completions_json(*export_args), export_format
+        )
+    if cache_key:
+        chunks = export_cache.stream(cache_key, chunks)
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    if cache_key:
+        response.set_etag(cache_key)
+    return response
+
+
+@app.route(
+    "/api/projects/<string:project_name>/completions/export/changes",
+    methods=["GET"],
+)
+@check_permission("Manager")
+def api_export_completion_changes(project_name: str):
+    """
+    Export only tasks changed after the given watermark, with tombstones of
+    deleted tasks and completions and the watermark to use next time
+    """
+    since = parse_timestamp(request.args.get("since"))
+    if not since:
+        return jsonify({"error": "Missing/invalid 'since' timestamp"}), 400
+
+    project_id = project_metadata.get(project_name).project_id
+    # Taken before reading so changes made meanwhile are exported next time
+    watermark = Completions.get_watermark(
+        app.config.get("EXPORT_WATERMARK_OVERLAP", 60)
+    )
+    records = iter_completions_json(
+        project_id,
+        request.args.getlist("tags", type=int),
+        request.args.get("ground_truth") == "true",
+        request.args.get("exclude_tasks_without_completions") == "true",
+        since=since,
+    )
+    return Response(
+        stream_with_context(
+            stream_incremental_export(
+                records, get_export_changes(project_id, since), watermark
+            )
+        ),
+        mimetype="application/json",
+    )
+
+
+@app.route(
+    "/api/projects/<string:project_name>/completions/import", methods=["POST"]
+)
+@check_permission("Manager")
+def api_import_completions(project_name: str):
+    """
+    Bulk import a JSON array of tasks with completions and predictions.
+    Progress is streamed back as one JSON line per imported batch.
+    """
+    project_id = project_metadata.get(project_name).project_id
+    progress = import_tasks_stream(
+        project_id,
+        request.stream,
+        request.username,
+        overwrite=request.args.get("overwrite") == "true",
+    )
+
+    def stream_progress():
+        for imported in progress:
+            yield json.dumps({"imported": imported}) + "\n"
+        # Remove output schema for current project, if its tuples changed
+        clear_output_schema_if_changed(project_name, project_id)
+
+    return Response(
+        stream_with_context(stream_progress()),
+        mimetype=EXPORT_MIMETYPES["jsonl"],
+    )
+
+
+@app.route(
+    "/api/projects/<string:project_name>/completions/bulk", methods=["POST"]
+)
+@check_permission("Annotator", "Reviewer", "Manager")
+def api_bulk_save_completions(project_name: str):
+    """
+    Save (or submit) new completions for many tasks at once.
+    Body: [{"task_id": .., "completion": {..}},]
+    Returns one {"task_id", "id"} or {"task_id", "error"} per item.
+    """
+    items = request.json
+    if not isinstance(items, list):
+        return jsonify({"error": "Expected a list of completions"}), 400
+
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
+    label_config = label_configs.get(project_id, project.label_config)
+    owner_or_manager = user_info(project_name)["owner_or_manager"]
+    acls = task_acls.get_many(
+        project_id,
+        [
+            item["task_id"]
+            for item in items
+            if isinstance(item, dict) and is_task_id(item.get("task_id"))
+        ],
+        fresh=True,
+    )
+
+    results = []
+    task_completions = {}
+    created_ago = datetime.now().isoformat() + "Z"
+    for item in items:
+        task_id = item.get("task_id") if isinstance(item, dict) else None
+        completion = item.get("completion") if is_task_id(task_id) else None
+        if not isinstance(completion, dict):
+            results.append(
+                {
+                    "task_id": task_id,
+                    "error": "Missing/invalid task_id/completion",
+                }
+            )
+            continue
+        acl = acls.get(task_id)
+        if not acl:
+            results.append({"task_id": task_id, "error": "Task not found"})
+            continue
+        if not acl.allows(request.username, owner_or_manager):
+            results.append({"task_id": task_id, "error": "Permission denied"})
+            continue
+        invalid_msg = validate_completion_data(completion, label_config)
+        if invalid_msg:
+            results.append({"task_id": task_id, "error": invalid_msg})
+            continue
+
+        completion.pop("state", None)  # remove editor state
+        completion["created_username"] = request.username
+        completion["created_ago"] = created_ago
+        task_completions.setdefault(acl.id, (task_id, []))[1].append(
+            completion
+        )
+        results.append({"task_id": task_id, "completion": completion})
+
+    if task_completions:
+        Completions.add_completions(
+            project_id, request.username, task_completions
+        )
+        saved = [
+            completion
+            for _, completions in task_completions.values()
+            for completion in completions
+        ]
+        update_completions_meta_table(project_id, new_completion=saved)
+        logger.info(f"PROJECT_ID={project_id} {len(saved)} COMPLETIONS SAVED!")
+
+        # Active learning
+        schedule_al_training(project_id, project_name)
+
+        # Remove output schema for current project, if its tuples changed
+        clear_output_schema_if_changed(project_name, project_id)
+
+    for result in results:
+        if "completion" in result:
+            result["id"] = result.pop("completion")["id"]
+    return jsonify(results), 201 if task_completions else 400
+
+
+@app.route(
+    "/api/projects/<string:project_name>/completions/copy", methods=["POST"]
+)
+@check_permission("Annotator", "Reviewer", "Manager")
+def api_copy_completions(project_name: str):
+    """
+    Copy a completion or prediction of each task into a new completion,
+    keeping the result items within confidence_range.
+    Body: {"task_ids": [..], "data_type": "prediction"|"completion",
+    "cid": .. (default: the last one of each task),
+    "confidence_range": [low, high], "submit": false}
+    Returns one {"task_id", "id"} or {"task_id", "error"} per task.
+    """
+    body = request.json or {}
+    task_ids = body.get("task_ids")
+    if not isinstance(task_ids, list) or not all(
+        is_task_id(task_id) for task_id in task_ids
+    ):
+        return jsonify({"error": "Missing/invalid task_ids"}), 400
+    confidence_range = body.get("confidence_range", [0, 1])
+    if (
+        not isinstance(confidence_range, list)
+        or len(confidence_range) != 2
+        or not all(
+            isinstance(bound, (int, float)) and not isinstance(bound, bool)
+            for bound in confidence_range
+        )
+    ):
+        return jsonify({"error": "Invalid confidence_range"}), 400
+    data_type = body.get("data_type", "prediction")
+    if data_type not in COPY_DATA_TYPES:
+        return jsonify({"error": "Invalid data_type"}), 400
+    cid = body.get("cid")
+    if cid is not None:
+        try:
+            cid = int(cid)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid cid"}), 400
+
+    project_id = project_metadata.get(project_name).project_id
+    owner_or_manager = user_info(project_name)["owner_or_manager"]
+    acls = task_acls.get_many(project_id, task_ids, fresh=True)
+    sources = Completions.get_copy_sources(
+        project_id,
+        [task_id for task_id in task_ids if task_id in acls],
+        data_type,
+        cid,
+    )
+
+    results = []
+    task_completions = {}
+    created_ago = datetime.now().isoformat() + "Z"
+    for task_id in task_ids:
+        acl = acls.get(task_id)
+        if not acl:
+            results.append({"task_id": task_id, "error": "Task not found"})
+            continue
+        if not acl.allows(request.username, owner_or_manager):
+            results.append({"task_id": task_id, "error": "Permission denied"})
+            continue
+        _, source = sources.get(task_id, (None, None))
+        if not source:
+            results.append({"task_id": task_id, "error": f"No {data_type}"})
+            continue
+        completion = {
+            "result": filter_copied_result(
+                source.get("result", []), confidence_range, data_type
+            ),
+            "created_username": request.username,
+            "created_ago": created_ago,
+        }
+        if body.get("submit"):
+            completion["submitted_at"] = created_ago
+        task_completions.setdefault(acl.id, (task_id, []))[1].append(
+            completion
+        )
+        results.append({"task_id": task_id, "completion": completion})
+
+    if task_completions:
+        Completions.add_completions(
+            project_id, request.username, task_completions
+        )
+        copied = [
+            completion
+            for _, completions in task_completions.values()
+            for completion in completions
+        ]
+        update_completions_meta_table(project_id, new_completion=copied)
+        logger.info(
+            f"PROJECT_ID={project_id} {len(copied)} COMPLETIONS COPIED!"
+        )
+
+        # Active learning
+        if body.get("submit"):
+            schedule_al_training(project_id, project_name)
+
+        # Remove output schema for current project, if its tuples changed
+        clear_output_schema_if_changed(project_name, project_id)
+
+    for result in results:
+        if "completion" in result:
+            result["id"] = result.pop("completion")["id"]
+    return jsonify(results), 201 if task_completions else 400
 
 
 @app.route(
@@ -42,30 +533,12 @@ def api_direct_submit_completions(project_name: str, task_id: int):
     """
     Save and submit new completion
     """
-    user_project = Projectai_project(name=project_name)
-    project_id = UserProjects.get_project_by_project_name_if_exists(
-        project_name=project_name, fields=["project_id"]
-    ).project_id
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
 
-    task_in_db = Tasks.get_task(project_id, task_id)
-
-    # Not support for multi-page PDF (Visual NER)
-    # Reason: PDF divided into pages, after submit 1st page,
-    # user is unable to save work for other pages.
-    if project_is_visual_ner(user_project.label_config_line) and isinstance(
-        task_in_db.data.get("image"), list
-    ):
-        return (
-            jsonify(
-                {
-                    "error": (
-                        "Direct submit is not supported for multi-page PDF for"
-                        " Visual NER project"
-                    )
-                }
-            ),
-            400,
-        )
+    task_acl = task_acls.get(project_id, task_id, fresh=True)
+    if not task_acl:
+        return jsonify({"error": "Task not found"}), 404
 
     completion = request.json
     if not completion.get("created_username"):
@@ -74,15 +547,12 @@ def api_direct_submit_completions(project_name: str, task_id: int):
         completion["created_ago"] = datetime.now().isoformat() + "Z"
 
     owner_or_manager = user_info(project_name)["owner_or_manager"]
-    allowed = (
-        owner_or_manager
-        or request.username in task_in_db.assigned_to
-        or request.username in task_in_db.reviewers
-    )
-    if not allowed:
+    if not task_acl.allows(request.username, owner_or_manager):
         return jsonify({"error": "Permission denied"}), 403
 
     completion.pop("state", None)  # remove editor state
+    completion["version"] = 1
+    user_project = Projectai_project(name=project_name)
     completion_id = user_project.save_completion(
         task_id, completion, request.username
     )
@@ -92,12 +562,12 @@ def api_direct_submit_completions(project_name: str, task_id: int):
     logger.info(f"TASK_ID={task_id} COMPLETION SAVED!")
 
     # Active learning
-    al_automatic_model_training(project_id, project_name)
+    schedule_al_training(project_id, project_name)
 
-    # Remove output schema for current project, if exists
-    Projectai_project.clear_derived_output_schema(project_name)
+    # Remove output schema for current project, if its tuples changed
+    clear_output_schema_if_changed(project_name, project_id)
 
-    return jsonify({"id": completion_id}), 201
+    return versioned_response({"id": completion_id}, 201, 1)
 
 
 @app.route(
@@ -109,74 +579,41 @@ def api_save_completions(project_name: str, task_id: int):
     """
     Save new completion
     """
-    user_project = Projectai_project(name=project_name)
-    project_id = UserProjects.get_project_by_project_name_if_exists(
-        project_name=project_name, fields=["project_id"]
-    ).project_id
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
 
     completion = request.json
     completion["created_username"] = request.username
     completion["created_ago"] = datetime.now().isoformat() + "Z"
     confidence_range = completion.get("confidence_range")
-    task_in_db = Tasks.get_task(project_id, task_id)
-    if not task_in_db:
+    task_acl = task_acls.get(project_id, task_id, fresh=True)
+    if not task_acl:
         return jsonify({"error": "Task not found"}), 404
     invalid_msg = validate_completion_data(
-        completion, user_project.parsed_label_config
+        completion, label_configs.get(project_id, project.label_config)
     )
     if invalid_msg:
         return jsonify({"error": invalid_msg}), 400
 
     owner_or_manager = user_info(project_name)["owner_or_manager"]
-    allowed = (
-        owner_or_manager
-        or request.username in task_in_db.assigned_to
-        or request.username in task_in_db.reviewers
-    )
-    if not allowed:
+    if not task_acl.allows(request.username, owner_or_manager):
         return jsonify({"error": "Permission denied"}), 403
     # For copying completion
     if completion.get("copy"):
-        completion_in_db = Completions.get_completion(task_in_db.id)
-        completion_data = (
-            completion_in_db.completions
-            if completion.get("data_type") == "completion"
-            else completion_in_db.predictions
-        )
-        for c in completion_data:
-            if c.get("id") == int(completion["cid"]):
-                result_ids = []
-                results = []
-                for result in c.get("result", []):
-                    if (
-                        result.get("value")
-                        and confidence_range[0]
-                        <= float(result["value"].get("confidence") or 0)
-                        <= confidence_range[1]
-                    ):
-                        if (
-                            result["value"].get("confidence") is None
-                            and confidence_range[0] == 0
-                        ):
-                            result["value"]["confidence"] = (
-                                1
-                                if completion["data_type"] == "completion"
-                                else 0
-                            )
-                        result_ids.append(result.get("id"))
-                        results.append(result)
-                    elif (
-                        result.get("direction")
-                        and result.get("from_id") in result_ids
-                        and result.get("to_id") in result_ids
-                    ):
-                        results.append(result)
-                completion["result"] = results
-                break
+        data_type = completion.get("data_type")
+        _, source = Completions.get_copy_sources(
+            project_id, [task_id], data_type, int(completion["cid"])
+        ).get(task_id, (None, None))
+        if source:
+            completion["result"] = filter_copied_result(
+                source.get("result", []), confidence_range, data_type
+            )
         completion.pop("copy", None)
 
     completion.pop("state", None)  # remove editor state
     completion.pop("confidence_range", None)
+    completion["version"] = 1
+    user_project = Projectai_project(name=project_name)
     completion_id = user_project.save_completion(
         task_id, completion, request.username
     )
@@ -185,9 +622,9 @@ def api_save_completions(project_name: str, task_id: int):
     logger.debug(f"OUTPUT={request.json}")
     logger.info(f"TASK_ID={task_id} COMPLETION SAVED!")
 
-    # Remove output schema for current project, if exists
-    Projectai_project.clear_derived_output_schema(project_name)
-    return jsonify({"id": completion_id}), 201
+    # Remove output schema for current project, if its tuples changed
+    clear_output_schema_if_changed(project_name, project_id)
+    return versioned_response({"id": completion_id}, 201, 1)
 
 
 @app.route(
@@ -201,11 +638,8 @@ def api_completion_by_id(project_name: str, task_id: int, completion_id: int):
     """
     Delete completion
     """
-    user_project = Projectai_project(name=project_name)
-
-    project_id = UserProjects.get_project_by_project_name_if_exists(
-        project_name=project_name, fields=["project_id"]
-    ).project_id
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
     completion_data = Completions.get_completion_owner_submitted_timestamp(
         project_id=project_id, task_id=task_id, completion_id=completion_id
     )
@@ -238,14 +672,19 @@ def api_completion_by_id(project_name: str, task_id: int, completion_id: int):
             400,
         )
 
-    if user_project.config.get("allow_delete_completions", False):
-        deleted_completion = user_project.delete_completions(
-            [task_id], completion_id
+    if project.allow_delete_completions:
+        deleted = Completions.soft_delete_completion(
+            task_acls.get(project_id, task_id).id,
+            completion_id,
+            datetime.now().isoformat() + "Z",
+            version=if_match_version(),
         )
-        kwargs = {"deleted_completion": deleted_completion}
+        if deleted is None:
+            return jsonify({"error": "Completion not found"}), 404
+        kwargs = {"deleted_completion": [{"result": deleted[0]}]}
         update_completions_meta_table(project_id, **kwargs)
-        # Remove output schema for current project, if exists
-        Projectai_project.clear_derived_output_schema(project_name)
+        # Remove output schema for current project, if its tuples changed
+        clear_output_schema_if_changed(project_name, project_id)
         return (
             jsonify({"message": "Task completions removed successfully."}),
             204,
@@ -285,21 +724,12 @@ def api_review_completion(project_name: str, task_id: int, completion_id: int):
     if not review_data["review_status"].get("reviewer"):
         review_data["review_status"].update({"reviewer": request.username})
 
-    user_project = Projectai_project(name=project_name)
-
-    project = UserProjects.get_project_by_project_name_if_exists(
-        project_name=project_name, fields=["project_id", "owner"]
-    )
-
-    if review_status.get("approved") is False:
-        review_data["honeypot"] = False
+    project = project_metadata.get(project_name)
 
-    completion_reviewer = Tasks.get_task(
-        project_id=project.project_id, task_id=task_id
-    )
-    if request.username not in [
-        *completion_reviewer.reviewers,
-        project.owner.get("username"),
+    task_acl = task_acls.get(project.project_id, task_id, fresh=True)
+    if not task_acl or request.username not in [
+        *task_acl.reviewers,
+        project.owner_username,
     ]:
         return (
             jsonify(
@@ -327,7 +757,7 @@ def api_review_completion(project_name: str, task_id: int, completion_id: int):
             400,
         )
     if completion_data.review_status:
-        reviewer = json.loads(completion_data.review_status).get("reviewer")
+        reviewer = completion_data.review_status.get("reviewer")
         return (
             jsonify(
                 {
@@ -338,18 +768,108 @@ def api_review_completion(project_name: str, task_id: int, completion_id: int):
             ),
             400,
         )
-    review_data["id"] = int(completion_id)
-    user_project.save_completion(task_id, review_data, request.username)
+    reviewed = Completions.set_review_status(
+        task_acl.id, completion_id, review_status, version=if_match_version()
+    )
+    if reviewed is None:
+        return jsonify({"error": "Completion not found"}), 404
 
     # Active learning
-    al_automatic_model_training(project.project_id, project_name)
+    schedule_al_training(project.project_id, project_name)
 
-    return (
-        jsonify({"message": "Completion review successfully submitted"}),
+    return versioned_response(
+        {"message": "Completion review successfully submitted"},
         201,
+        reviewed[1],
     )
 
 
+@app.route(
+    "/api/projects/<string:project_name>/completions/review",
+    methods=["PATCH"],
+)
+@check_permission("Update", "Reviewer")
+def api_bulk_review_completions(project_name: str):
+    """
+    Add reviews to many completions at once.
+    Body: [{"task_id": .., "completion_id": .., "review_status": {..}},]
+    Returns one {"task_id", "completion_id"[, "error"]} per item.
+    """
+    items = request.json
+    if not isinstance(items, list):
+        return jsonify({"error": "Expected a list of reviews"}), 400
+
+    project = project_metadata.get(project_name)
+    owner = project.owner_username
+    keys = [
+        (item.get("task_id"), item.get("completion_id"))
+        for item in items
+        if isinstance(item, dict)
+    ]
+    review_states = Completions.get_review_states(project.project_id, keys)
+
+    results = []
+    reviews = {}
+    pending = {}
+    reviewed_at = datetime.now().isoformat() + "Z"
+    for item in items:
+        if not isinstance(item, dict):
+            item = {}
+        key = (item.get("task_id"), item.get("completion_id"))
+        result = {"task_id": key[0], "completion_id": key[1]}
+        results.append(result)
+        review_status = item.get("review_status")
+        if not isinstance(review_status, dict) or (
+            "approved" not in review_status
+        ):
+            result["error"] = "Invalid review data"
+            continue
+        completion_data = review_states.get(key)
+        if not completion_data:
+            result["error"] = "Completion not found"
+            continue
+        if request.username not in [*completion_data.reviewers, owner]:
+            result["error"] = (
+                f"User '{request.username}' is not allowed to review "
+                "the completion."
+            )
+            continue
+        if not completion_data.submitted_at:
+            result["error"] = "Cannot review unsubmitted completions!"
+            continue
+        task_reviews = reviews.setdefault(completion_data.task_pk, {})
+        if completion_data.review_status or key[1] in task_reviews:
+            reviewer = (completion_data.review_status or {}).get(
+                "reviewer", request.username
+            )
+            result["error"] = (
+                f"Completion is already reviewed by user '{reviewer}'"
+            )
+            continue
+
+        review_status.setdefault("reviewed_at", reviewed_at)
+        review_status.setdefault("reviewer", request.username)
+        review_data = {"review_status": review_status}
+        if review_status.get("approved") is False:
+            review_data["honeypot"] = False
+        task_reviews[key[1]] = review_data
+        pending[(completion_data.task_pk, key[1])] = result
+
+    reviews = {pk: reviews[pk] for pk in reviews if reviews[pk]}
+    if reviews:
+        # Reviewed or changed by someone else since review_states was read
+        for key in Completions.add_reviews(reviews):
+            pending.pop(key)["error"] = (
+                "Completion is already reviewed or not submitted"
+            )
+
+    if pending:
+        # Active learning
+        schedule_al_training(project.project_id, project_name)
+
+    return jsonify(results), 201 if pending else 400
+
+
 @app.route(
     (
         "/api/projects/<string:project_name>/tasks/<int:task_id>/completions"
@@ -361,11 +881,8 @@ def api_completion_update(project_name: str, task_id: int, completion_id: int):
     """
     Rewrite existing completion with patch
     """
-    user_project = Projectai_project(name=project_name)
-
-    project_id = UserProjects.get_project_by_project_name_if_exists(
-        project_name=project_name, fields=["project_id"]
-    ).project_id
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
 
     completion_data = Completions.get_completion_owner_submitted_timestamp(
         project_id=project_id, task_id=task_id, completion_id=completion_id
@@ -375,7 +892,7 @@ def api_completion_update(project_name: str, task_id: int, completion_id: int):
         return jsonify({"error": "Completion Not Found"}), 404
 
     invalid_msg = validate_completion_data(
-        request.json, user_project.parsed_label_config
+        request.json, label_configs.get(project_id, project.label_config)
     )
     if invalid_msg:
         return jsonify({"error": invalid_msg}), 400
@@ -396,8 +913,18 @@ def api_completion_update(project_name: str, task_id: int, completion_id: int):
     completion = deepcopy(request.json)
     new_completion = deepcopy(request.json)
 
-    if completion_data.submitted_at and ["honeypot"] != list(
-        completion.keys()
+    current_page = int(request.args.get("current_page", 1))
+    multi_page = project.is_visual_ner and isinstance(
+        Tasks.get_task(project_id, task_id).data.get("image"), list
+    )
+    page_save = multi_page and "result" in completion
+    # Pages of a multi-page PDF (Visual NER) are saved independently, so
+    # they can still be saved once the completion is submitted, until it
+    # is reviewed
+    if (
+        completion_data.submitted_at
+        and ["honeypot"] != list(completion.keys())
+        and not (page_save and not completion_data.review_status)
     ):
         return (
             jsonify(
@@ -411,59 +938,218 @@ def api_completion_update(project_name: str, task_id: int, completion_id: int):
             400,
         )
 
-    current_page = int(request.args.get("current_page", 1))
-    task_in_db = Tasks.get_task(project_id, task_id)
-
-    completion_in_db = Completions.get_completion(task_in_db.id)
-    existing_completion = deepcopy(
-        next(
-            (
-                c
-                for c in completion_in_db.completions
-                if c.get("id") == completion_id
-            ),
-            {},
+    task_pk = task_acls.get(project_id, task_id).id
+    if ["honeypot"] == list(completion.keys()):
+        # Ground truth toggle: labels and output schema are unchanged
+        saved = Completions.set_honeypot(
+            task_pk,
+            completion_id,
+            completion["honeypot"],
+            version=if_match_version(),
         )
-    )
+        if saved is None:
+            return jsonify({"error": "Completion Not Found"}), 404
+        logger.info(f"TASK_ID={task_id} COMPLETION HONEYPOT SET!")
 
-    if project_is_visual_ner(user_project.label_config_line) and isinstance(
-        task_in_db.data.get("image"), list
-    ):
-        completion_in_db = Completions.get_completion(task_in_db.id)
-        for c in completion_in_db.completions:
-            if c.get("id") == completion_id:
-                results = c.get("result", [])
-                new_result = []
-                for result in results:
-                    if current_page != result.get("pageNumber"):
-                        new_result.append(result)
-                if completion.get("result") or new_result:
-                    completion["result"] = (
-                        completion.get("result", []) + new_result
-                    )
+        # Active learning
+        schedule_al_training(project_id, project_name)
+        return versioned_response(
+            {"message": "Completion updated successfully."}, 201, saved[1]
+        )
 
     completion.pop("state", None)  # remove editor state
+    completion.pop("version", None)
     completion["id"] = int(completion_id)
     if not completion_data.submitted_at:
         completion["updated_at"] = datetime.now().isoformat() + "Z"
         completion["updated_by"] = request.username
-    user_project.save_completion(task_id, completion, request.username)
-    if existing_completion.get("result"):
+    if page_save:
+        # Multi-page PDF (Visual NER): only the current page is written,
+        # and only its items once the completion is submitted
+        page_items = completion.pop("result")
+        saved = Completions.save_page(
+            task_pk,
+            completion_id,
+            current_page,
+            page_items,
+            {} if completion_data.submitted_at else completion,
+            version=if_match_version(),
+        )
+        if saved is None:
+            return jsonify({"error": "Completion Not Found"}), 404
+        replaced_items, version = saved
         kwargs = {
             "updated_completion": {
-                "old": [existing_completion],
-                "new": [new_completion],
+                "old": [{"result": replaced_items}],
+                "new": [{"result": page_items}],
             }
         }
     else:
-        kwargs = {"new_completion": [new_completion]}
+        saved = Completions.update_completion_element(
+            task_pk, completion_id, completion, version=if_match_version()
+        )
+        if saved is None:
+            return jsonify({"error": "Completion Not Found"}), 404
+        existing_completion, version = saved
+        if existing_completion.get("result"):
+            kwargs = {
+                "updated_completion": {
+                    "old": [existing_completion],
+                    "new": [new_completion],
+                }
+            }
+        else:
+            kwargs = {"new_completion": [new_completion]}
     update_completions_meta_table(project_id, **kwargs)
     logger.debug(f"OUTPUT={request.json}")
     logger.info(f"TASK_ID={task_id} COMPLETION SAVED!")
 
     # Active learning
-    al_automatic_model_training(project_id, project_name)
+    schedule_al_training(project_id, project_name)
+
+    # Remove output schema for current project, if its tuples changed
+    clear_output_schema_if_changed(project_name, project_id)
+    return versioned_response(
+        {"message": "Completion updated successfully."}, 201, version
+    )
+
+
+@app.route(
+    (
+        "/api/projects/<string:project_name>/tasks/<int:task_id>/completions"
+        "/<int:completion_id>/delta"
+    ),
+    methods=["PATCH"],
+)
+def api_completion_delta_update(
+    project_name: str, task_id: int, completion_id: int
+):
+    """
+    Update existing completion with result items added, removed and
+    changed since the last save.
+    Body: {"added": [item,], "removed": [item id,], "changed": [item,]}
+    """
+    delta = request.json or {}
+    if not isinstance(delta, dict):
+        return jsonify({"error": "Invalid delta format"}), 400
+    added = delta.get("added", [])
+    removed = delta.get("removed", [])
+    changed = delta.get("changed", [])
+    if not all(isinstance(items, list) for items in (added, removed, changed)):
+        return jsonify({"error": "Invalid delta format"}), 400
+    if not all(isinstance(item, dict) for item in [*added, *changed]):
+        return jsonify({"error": "Result items should be objects"}), 400
+    if any(isinstance(item_id, (dict, list)) for item_id in removed):
+        return jsonify({"error": "Removed items should be item ids"}), 400
+    if any(item.get("id") is None for item in changed):
+        return jsonify({"error": "Changed result items need an id"}), 400
+
+    project = project_metadata.get(project_name)
+    project_id = project.project_id
+
+    completion_data = Completions.get_completion_owner_submitted_timestamp(
+        project_id=project_id, task_id=task_id, completion_id=completion_id
+    )
+    if not completion_data:
+        return jsonify({"error": "Completion Not Found"}), 404
+
+    invalid_msg = validate_completion_data(
+        {"result": [*added, *changed]},
+        label_configs.get(project_id, project.label_config),
+    )
+    if invalid_msg:
+        return jsonify({"error": invalid_msg}), 400
+
+    if request.username not in completion_data.created_username:
+        return (
+            jsonify(
+                {
+                    "error": (
+                        f"user '{request.username}' is not allowed to "
+                        "update the completion."
+                    )
+                }
+            ),
+            400,
+        )
+    if completion_data.submitted_at:
+        return (
+            jsonify(
+                {
+                    "error": (
+                        "Completion is already submitted. Cannot "
+                        "update submitted completion!"
+                    )
+                }
+            ),
+            400,
+        )
+
+    applied = Completions.apply_result_delta(
+        task_acls.get(project_id, task_id).id,
+        completion_id,
+        added,
+        removed,
+        changed,
+        {
+            "updated_at": datetime.now().isoformat() + "Z",
+            "updated_by": request.username,
+        },
+        version=if_match_version(),
+    )
+    if applied is None:
+        return jsonify({"error": "Completion Not Found"}), 404
+    old_items, new_items, version = applied
+    kwargs = {
+        "updated_completion": {
+            "old": [{"result": old_items}],
+            "new": [{"result": new_items}],
+        }
+    }
+    update_completions_meta_table(project_id, **kwargs)
+    logger.info(
+        f"TASK_ID={task_id} COMPLETION UPDATED: {len(new_items)} ITEMS SET,"
+        f" {len(old_items)} ITEMS REPLACED/REMOVED"
+    )
+
+    # Active learning
+    schedule_al_training(project_id, project_name)
+
+    # Remove output schema for current project, if its tuples changed
+    clear_output_schema_if_changed(project_name, project_id)
+    return versioned_response(
+        {"message": "Completion updated successfully."}, 201, version
+    )
+
 
-    # Remove output schema for current project, if exists
-    Projectai_project.clear_derived_output_schema(project_name)
-    return jsonify({"message": "Completion updated successfully."}), 201
+@app.route(
+    (
+        "/api/projects/<string:project_name>/tasks/<int:task_id>/completions"
+        "/<int:completion_id>/pages/<int:page_number>"
+    ),
+    methods=["GET"],
+)
+@check_permission("Annotator", "Reviewer", "Manager")
+def api_completion_page(
+    project_name: str, task_id: int, completion_id: int, page_number: int
+):
+    """
+    Result items of one page of a multi-page PDF (Visual NER) completion
+    """
+    project_id = project_metadata.get(project_name).project_id
+    task_acl = task_acls.get(project_id, task_id)
+    if not task_acl:
+        return jsonify({"error": "Task not found"}), 404
+    owner_or_manager = user_info(project_name)["owner_or_manager"]
+    if not task_acl.allows(request.username, owner_or_manager):
+        return jsonify({"error": "Permission denied"}), 403
+    return (
+        jsonify(
+            {
+                "result": Completions.get_page(
+                    task_acl.id, completion_id, page_number
+                )
+            }
+        ),
+        200,
+    )
@@ -1,10 +1,50 @@
-from collections import defaultdict
-from ai_project.models.completions import Completions, CompletionsMeta
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zipfile
+import click
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from flask import g, has_app_context
+from sqlalchemy import event, func, inspect, text
+from sqlalchemy.orm import Session
+from ai_project.db import app, db
+from ai_project.models.completions import (
+    CompletionCounters,
+    CompletionItems,
+    Completions,
+    CompletionsMeta,
+    CompletionTombstones,
+    CompiledLabelConfig,
+    completion_trigger_ddl,
+    is_honeypot,
+    label_configs,
+    lock_project_totals,
+    parse_timestamp,
+    rebuild_derived_tables,
+    to_number,
+)
 from ai_project.models.user_projects import UserProjects
-from ai_project.utils.labeling_config import parse_config
+from ai_project.helpers.model_training import al_automatic_model_training
+from ai_project.helpers.projectai_project import (
+    Projectai_project,
+    project_is_visual_ner,
+)
 from ai_project.utils.misc import logger
 from ai_project.models.tasks import Tasks
 
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_SHARD_SIZE = 10000
+PARQUET_ROW_GROUP_SIZE = 100000
+IMPORT_BATCH_SIZE = 1000
+
 
 def completion_to_exclude(
     completion, reviewer, assignee, owner_or_manager, username
@@ -30,55 +70,1040 @@ def filter_ground_truth(completions):
     return new_completions
 
 
-def prepare_completions_json(
+def export_fields():
+    return [
+        Completions.completions,
+        Completions.predictions,
+        Completions.created_at,
+        Completions.created_by,
+        Completions.data,
+        Completions.title,
+        Completions.completion_id,
+    ]
+
+
+def prepare_export_record(item, ground_truth_flag):
+    filtered_completions = []
+    if item.completions:
+        filtered_completions = [
+            completion
+            for completion in item.completions
+            if not completion.get("deleted_at")
+        ]
+    data = dict(item.data)
+    data.pop("pagination", None)
+    export_json = {
+        "completions": filtered_completions
+        if not ground_truth_flag
+        else filter_ground_truth(filtered_completions),
+        "predictions": item.predictions or [],
+        "created_at": item.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+        "created_by": item.created_by,
+        "data": data,
+        "id": item.completion_id
+        if item.completion_id is not None
+        else item.task_id,
+    }
+    if item.title:
+        export_json["data"].update({"title": item.title})
+    return export_json
+
+
+def iter_completions_json(
     project_id,
     tags: list,
     ground_truth_flag,
     exclude_tasks_without_completions_flag,
+    batch_size=EXPORT_BATCH_SIZE,
+    task_id_range=None,
+    since=None,
 ):
+    """
+    Yield export records one at a time. Rows are fetched through a server
+    side cursor, batch_size at a time, so memory does not grow with the
+    size of the project.
+    :param task_id_range: optional inclusive (first, last) task ids
+    :param since: only tasks modified after this timestamp
+    """
     if exclude_tasks_without_completions_flag:
-        data = Completions.get_completions(
+        task_id = Completions.completion_id
+        query = Completions.get_completions_query(
             project_id=project_id,
             tags=tags,
             ground_truth=ground_truth_flag,
-            fields=[
-                Completions.completions,
-                Completions.predictions,
-                Completions.created_at,
-                Completions.created_by,
-                Completions.data,
-                Completions.title,
-                Completions.completion_id,
-            ],
+            fields=export_fields(),
+            since=since,
         )
     else:
-        data = Tasks.get_all_tasks_with_completions(project_id, tags)
-    final_data = list()
-    for item in data:
-        filtered_completions = []
-        if item.completions:
-            filtered_completions = [
-                completion
-                for completion in item.completions
-                if not completion.get("deleted_at")
-            ]
-        item.data.pop("pagination", None)
-        export_json = {
-            "completions": filtered_completions
-            if not ground_truth_flag
-            else filter_ground_truth(filtered_completions),
-            "predictions": item.predictions or [],
-            "created_at": item.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-            "created_by": item.created_by,
-            "data": item.data,
-            "id": item.completion_id
-            if item.completion_id is not None
-            else item.task_id,
+        task_id = Tasks.task_id
+        query = Completions.get_tasks_with_completions_query(
+            project_id, tags, since=since
+        )
+    if task_id_range:
+        query = query.filter(task_id.between(*task_id_range))
+    for item in query.order_by(task_id).yield_per(batch_size):
+        yield prepare_export_record(item, ground_truth_flag)
+
+
+def prepare_completions_json(
+    project_id,
+    tags: list,
+    ground_truth_flag,
+    exclude_tasks_without_completions_flag,
+    since=None,
+):
+    return list(
+        iter_completions_json(
+            project_id,
+            tags,
+            ground_truth_flag,
+            exclude_tasks_without_completions_flag,
+            since=since,
+        )
+    )
+
+
+def get_export_changes(project_id, since):
+    """
+    Tombstones of what was deleted after since: whole tasks and single
+    (soft deleted) completions
+    """
+    return {
+        "tasks": CompletionTombstones.get_task_ids_since(project_id, since),
+        "completions": [
+            {"task_id": task_id, "id": completion_id}
+            for task_id, completion_id in CompletionItems.get_deleted_since(
+                project_id, since
+            )
+        ],
+    }
+
+
+def stream_incremental_export(records, deleted, watermark):
+    """
+    Serialize an incremental export as one JSON object:
+    {"watermark": ..., "deleted": {...}, "tasks": [...]}
+    """
+    yield (
+        f'{{"watermark": {json.dumps(watermark.isoformat())}, '
+        f'"deleted": {json.dumps(deleted)}, "tasks": '
+    )
+    yield from stream_export(records)
+    yield "}"
+
+
+def stream_export(records, export_format="json"):
+    """
+    Serialize export records as a JSON array or as JSON lines, in chunks of
+    about EXPORT_CHUNK_SIZE characters for a streamed HTTP response.
+    """
+    buffer = []
+    size = 0
+    if export_format != "jsonl":
+        buffer.append("[")
+    for index, record in enumerate(records):
+        if export_format == "jsonl":
+            chunk = json.dumps(record) + "\n"
+        else:
+            chunk = ("," if index else "") + json.dumps(record)
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if export_format != "jsonl":
+        buffer.append("]")
+    yield "".join(buffer)
+
+
+def export_shard_ranges(
+    project_id, exclude_tasks_without_completions_flag, shard_size
+):
+    """
+    Split the task id range of the project into inclusive (first, last)
+    ranges of shard_size ids
+    """
+    first, last = Completions.get_task_id_range(
+        project_id, with_tasks=not exclude_tasks_without_completions_flag
+    )
+    if first is None:
+        return []
+    return [
+        (start, min(start + shard_size - 1, last))
+        for start in range(first, last + 1, shard_size)
+    ]
+
+
+def _export_shard(args):
+    (
+        project_id,
+        tags,
+        ground_truth_flag,
+        exclude_tasks_without_completions_flag,
+        task_id_range,
+        export_format,
+    ) = args
+    with app.app_context():
+        records = iter_completions_json(
+            project_id,
+            tags,
+            ground_truth_flag,
+            exclude_tasks_without_completions_flag,
+            task_id_range=task_id_range,
+        )
+        if export_format == "jsonl":
+            return "".join(json.dumps(record) + "\n" for record in records)
+        return ",".join(json.dumps(record) for record in records)
+
+
+class ExportPool:
+    """
+    Process pool shared by the parallel exports of the process. Workers are
+    spawned rather than forked, so they inherit no lock or connection of
+    the web server, and live as long as the pool. A pool created before a
+    fork, or broken by a dead worker, is replaced on the next use.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers or os.cpu_count(),
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+                self.pid = os.getpid()
+            return self.executor
+
+    def discard(self, executor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False)
+
+
+export_pool = ExportPool(app.config.get("EXPORT_WORKERS"))
+
+
+def export_workers(workers=None):
+    """
+    Shards in flight for one parallel export: the requested number, else the
+    EXPORT_WORKERS setting. None means the export runs in the request.
+    """
+    return workers or app.config.get("EXPORT_WORKERS") or None
+
+
+def iter_export_shards(
+    project_id,
+    tags: list,
+    ground_truth_flag,
+    exclude_tasks_without_completions_flag,
+    export_format="json",
+    workers=None,
+    shard_size=EXPORT_SHARD_SIZE,
+):
+    """
+    Fetch and serialize shards of the project in the export pool and yield
+    the serialized shards in task id order. At most two shards per worker
+    are in flight, so memory is bounded by the shard size.
+    """
+    workers = export_workers(workers) or os.cpu_count()
+    shards = [
+        (
+            project_id,
+            tags,
+            ground_truth_flag,
+            exclude_tasks_without_completions_flag,
+            task_id_range,
+            export_format,
+        )
+        for task_id_range in export_shard_ranges(
+            project_id, exclude_tasks_without_completions_flag, shard_size
+        )
+    ]
+    executor = export_pool.get()
+    pending = deque()
+    try:
+        for shard in shards:
+            pending.append(executor.submit(_export_shard, shard))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        export_pool.discard(executor)
+        raise
+    finally:
+        # A client that disconnects must not leave its shards queued
+        for future in pending:
+            future.cancel()
+
+
+def stream_parallel_export(shards, export_format="json"):
+    """
+    Stitch serialized shards into one JSON array or JSON lines stream
+    """
+    if export_format == "jsonl":
+        yield from shards
+        return
+    yield "["
+    first = True
+    for shard in shards:
+        if not shard:
+            continue
+        yield shard if first else "," + shard
+        first = False
+    yield "]"
+
+
+def write_export_archive(shards, sink, export_format="json"):
+    """
+    Write every serialized shard as its own file of a zip archive
+    """
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        for index, shard in enumerate(shards):
+            if export_format == "jsonl":
+                archive.writestr(f"part-{index:05d}.jsonl", shard)
+            else:
+                archive.writestr(f"part-{index:05d}.json", f"[{shard}]")
+
+
+class ExportCache:
+    """
+    Exports kept on local disk, keyed by everything that determines their
+    content. Least recently used files are evicted past max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(
+        project_id,
+        revision,
+        tags: list,
+        ground_truth_flag,
+        exclude_tasks_without_completions_flag,
+        export_format,
+    ):
+        parts = [
+            project_id,
+            revision,
+            sorted(tags),
+            bool(ground_truth_flag),
+            bool(exclude_tasks_without_completions_flag),
+            export_format,
+        ]
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def write(self, key, write_func):
+        """
+        Cache the file written by write_func(file) and return its path.
+        Without a key, the file is not cached: an unnamed temporary file,
+        open and rewound, is returned instead.
+        """
+        if key is None:
+            file = tempfile.TemporaryFile(dir=self.directory)
+            try:
+                write_func(file)
+            except BaseException:
+                file.close()
+                raise
+            file.seek(0)
+            return file
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                write_func(file)
+            os.replace(temp_path, self.path(key))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict()
+        return self.path(key)
+
+    def stream(self, key, chunks):
+        """
+        Yield chunks while writing them to the cache. The entry is only
+        kept when the stream is consumed to the end.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    file.write(
+                        chunk.encode() if isinstance(chunk, str) else chunk
+                    )
+                    yield chunk
+            os.replace(temp_path, self.path(key))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+export_cache = ExportCache(
+    app.config.get(
+        "EXPORT_CACHE_DIR",
+        os.path.join(tempfile.gettempdir(), "completions_export_cache"),
+    ),
+    app.config.get("EXPORT_CACHE_MAX_SIZE", 2 * 1024**3),
+)
+
+
+def iter_result_rows(records):
+    """
+    Flatten export records into one row per label of every result item
+    """
+    for record in records:
+        for source in ("completions", "predictions"):
+            for completion in record[source]:
+                common = {
+                    "task_id": record["id"],
+                    "completion_id": completion.get("id"),
+                    "source": source[:-1],
+                    "username": completion.get("created_username"),
+                    "honeypot": is_honeypot(completion),
+                    "submitted_at": parse_timestamp(
+                        completion.get("submitted_at")
+                    ),
+                }
+                for result in completion.get("result") or []:
+                    value = result.get("value") or {}
+                    labels = value.get(result.get("type"))
+                    if not isinstance(labels, list) or not labels:
+                        labels = [None]
+                    row = {
+                        **common,
+                        "from_name": result.get("from_name"),
+                        "to_name": result.get("to_name"),
+                        "type": result.get("type"),
+                        "start": to_number(value.get("start")),
+                        "end": to_number(value.get("end")),
+                        "x": to_number(value.get("x")),
+                        "y": to_number(value.get("y")),
+                        "width": to_number(value.get("width")),
+                        "height": to_number(value.get("height")),
+                        "confidence": to_number(value.get("confidence")),
+                    }
+                    for label in labels:
+                        yield {
+                            **row,
+                            "label": label
+                            if label is None or isinstance(label, str)
+                            else str(label),
+                        }
+
+
+def write_completions_parquet(
+    records, sink, row_group_size=PARQUET_ROW_GROUP_SIZE
+):
+    """
+    Write flattened result rows to a Parquet file, one row group at a time.
+    Requires pyarrow.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    schema = pa.schema(
+        [
+            ("task_id", pa.int64()),
+            ("completion_id", pa.int64()),
+            ("source", dictionary),
+            ("username", dictionary),
+            ("from_name", dictionary),
+            ("to_name", dictionary),
+            ("type", dictionary),
+            ("label", dictionary),
+            ("start", pa.float64()),
+            ("end", pa.float64()),
+            ("x", pa.float64()),
+            ("y", pa.float64()),
+            ("width", pa.float64()),
+            ("height", pa.float64()),
+            ("confidence", pa.float64()),
+            ("honeypot", pa.bool_()),
+            ("submitted_at", pa.timestamp("us", tz="UTC")),
+        ]
+    )
+    with pq.ParquetWriter(sink, schema) as writer:
+        rows = []
+        for row in iter_result_rows(records):
+            rows.append(row)
+            if len(rows) == row_group_size:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+
+
+def iter_import_items(stream):
+    """
+    Tasks of a JSON array, parsed incrementally when ijson is installed
+    """
+    try:
+        import ijson
+    except ImportError:
+        items = json.load(stream)
+        yield from items if isinstance(items, list) else [items]
+        return
+    yield from ijson.items(stream, "item", use_float=True)
+
+
+def _parse_import_created_at(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return func.now()
+
+
+def import_tasks_batch(project_id, items: list, created_by, overwrite: bool):
+    """
+    Import one batch of exported tasks: one INSERT for new tasks, one
+    upsert for their completions and one update of the label counters.
+    With overwrite, tasks that exist get their data and title replaced.
+    """
+    existing = (
+        Completions.get_tasks_for_import(
+            project_id,
+            [item["id"] for item in items if item.get("id") is not None],
+        )
+        if overwrite
+        else {}
+    )
+    new_tasks = []
+    updated_tasks = []
+    completion_rows = []
+    old_completions = []
+    new_completions = []
+    for item in items:
+        data = dict(item.get("data") or {})
+        title = data.pop("title", "") or ""
+        created_at = _parse_import_created_at(item.get("created_at"))
+        task_id = item.get("id")
+        if task_id in existing:
+            old_completions.extend(existing[task_id].completions or [])
+            updated_tasks.append(
+                {
+                    "task_pk": existing[task_id].id,
+                    "data": data,
+                    "title": title,
+                }
+            )
+            task = {"task_id": task_id}
+        else:
+            # Numbered by Completions.insert_tasks
+            task = {
+                "project_id": project_id,
+                "data": data,
+                "title": title,
+                "created_by": item.get("created_by") or created_by,
+                "created_at": created_at,
+            }
+            new_tasks.append(task)
+        completions = item.get("completions") or []
+        new_completions.extend(completions)
+        completion_rows.append(
+            (
+                task,
+                {
+                    "project_id": project_id,
+                    "data": data,
+                    "title": title,
+                    "completions": completions,
+                    "predictions": item.get("predictions") or [],
+                    "created_by": item.get("created_by") or created_by,
+                    "created_at": created_at,
+                },
+            )
+        )
+
+    task_pks = {task_id: row.id for task_id, row in existing.items()}
+    task_pks.update(Completions.insert_tasks(project_id, new_tasks))
+    Completions.update_tasks(updated_tasks)
+    for task, row in completion_rows:
+        row["completion_id"] = task["task_id"]
+        row["id"] = task_pks[task["task_id"]]
+    Completions.upsert_completions([row for _, row in completion_rows])
+    db.session.commit()
+
+    update_completions_meta_table(
+        project_id,
+        updated_completion={"old": old_completions, "new": new_completions},
+    )
+
+
+def import_tasks_stream(
+    project_id,
+    stream,
+    created_by,
+    overwrite=False,
+    batch_size=IMPORT_BATCH_SIZE,
+):
+    """
+    Import a JSON array of exported tasks batch by batch, yielding the
+    number of tasks imported so far after every batch
+    """
+    imported = 0
+    batch = []
+    for item in iter_import_items(stream):
+        batch.append(item)
+        if len(batch) == batch_size:
+            import_tasks_batch(project_id, batch, created_by, overwrite)
+            imported += len(batch)
+            batch = []
+            yield imported
+    if batch:
+        import_tasks_batch(project_id, batch, created_by, overwrite)
+        imported += len(batch)
+    yield imported
+
+
+@app.cli.command("rebuild-completion-counters")
+@click.argument("project_ids", nargs=-1, type=int)
+def rebuild_completion_counters(project_ids):
+    """
+    Recount completion counters of the given projects (default: all)
+    """
+    if not project_ids:
+        project_ids = [
+            project_id
+            for project_id, in db.session.query(
+                Completions.project_id
+            ).distinct()
+        ]
+    for project_id in project_ids:
+        connection = db.session.connection()
+        lock_project_totals(connection, project_id)
+        CompletionCounters.rebuild(connection, project_id)
+        db.session.commit()
+        logger.info(f"PROJECT_ID={project_id} COMPLETION COUNTERS REBUILT")
+
+
+@app.cli.command("rebuild-derived-tables")
+@click.argument("project_ids", nargs=-1, type=int)
+def rebuild_derived_tables_command(project_ids):
+    """
+    Recompute completion items, annotation spans, counters and output
+    schema tuples of the given projects (default: all) from Completions
+    """
+    if not project_ids:
+        project_ids = [
+            project_id
+            for project_id, in db.session.query(
+                Completions.project_id
+            ).distinct()
+        ]
+    for project_id in project_ids:
+        rebuild_derived_tables(project_id)
+        logger.info(f"PROJECT_ID={project_id} DERIVED TABLES REBUILT")
+
+
+@app.cli.command("benchmark-completion-unnest")
+@click.option("--completions", default=100000, help="Synthetic completions")
+@click.option("--results", default=5, help="Result items per completion")
+@click.option("--repeat", default=3, help="Runs of each query")
+def benchmark_completion_unnest(completions, results, repeat):
+    """
+    Time the result detail scan over a synthetic project, with one
+    set-returning call per projected field (before Completions.unnested)
+    and with each array unnested once through a LATERAL join (after).
+    The synthetic rows live in a temporary table that is rolled back.
+    """
+    per_task = 2
+    db.session.execute(
+        text(
+            """
+            CREATE TEMP TABLE benchmark_completions ON COMMIT DROP AS
+            SELECT t AS id, (
+                SELECT jsonb_agg(jsonb_build_object(
+                    'id', t * 1000 + c,
+                    'created_username', 'user' || c,
+                    'result', (
+                        SELECT jsonb_agg(jsonb_build_object(
+                            'from_name', 'label',
+                            'to_name', 'text',
+                            'type', 'labels',
+                            'value', jsonb_build_object(
+                                'start', r, 'end', r + 5,
+                                'labels', jsonb_build_array('PER')
+                            )
+                        ))
+                        FROM generate_series(1, :results) AS r
+                    )
+                ))
+                FROM generate_series(1, :per_task) AS c
+            ) AS completions
+            FROM generate_series(1, :tasks) AS t
+            """
+        ),
+        {
+            "tasks": max(completions // per_task, 1),
+            "per_task": per_task,
+            "results": results,
+        },
+    )
+    queries = {
+        "before": """
+            SELECT count(*) FROM (
+                SELECT
+                    jsonb_array_elements(
+                        jsonb_array_elements(completions) -> 'result'
+                    ) -> 'from_name' AS from_name,
+                    jsonb_array_elements(
+                        jsonb_array_elements(completions) -> 'result'
+                    ) -> 'to_name' AS to_name,
+                    jsonb_array_elements(
+                        jsonb_array_elements(completions) -> 'result'
+                    ) -> 'type' AS type,
+                    jsonb_array_elements(
+                        jsonb_array_elements(completions) -> 'result'
+                    ) -> 'value' AS value,
+                    jsonb_array_elements(completions) ->> 'deleted_at'
+                        AS deleted_at
+                FROM benchmark_completions
+            ) AS s WHERE deleted_at IS NULL
+            """,
+        "after": """
+            SELECT count(*) FROM (
+                SELECT r.value -> 'from_name' AS from_name,
+                    r.value -> 'to_name' AS to_name,
+                    r.value -> 'type' AS type,
+                    r.value -> 'value' AS value
+                FROM benchmark_completions AS c
+                JOIN LATERAL jsonb_array_elements(c.completions)
+                    AS e ON true
+                JOIN LATERAL jsonb_array_elements(
+                    coalesce(e.value -> 'result', '[]')
+                ) AS r ON true
+                WHERE e.value ->> 'deleted_at' IS NULL
+            ) AS s
+            """,
+    }
+    try:
+        for name, query in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                rows = db.session.execute(text(query)).scalar()
+                timings.append(time.perf_counter() - started)
+            logger.info(
+                f"{name.upper()}: {rows} RESULTS, BEST OF {repeat}"
+                f" {min(timings):.3f}s"
+            )
+    finally:
+        db.session.rollback()
+
+
+@app.cli.command("install-completion-triggers")
+def install_completion_triggers():
+    """
+    Create or replace the triggers maintaining project revisions,
+    completion tombstones and tag counters, in one transaction
+    """
+    for statement in completion_trigger_ddl():
+        db.session.execute(text(statement))
+    db.session.commit()
+    logger.info("COMPLETION TRIGGERS INSTALLED")
+
+
+class ProjectMetadata:
+    """
+    Project fields completion handlers check before doing any work
+    """
+
+    def __init__(self, project, user_project):
+        self.project_id = project.project_id
+        self.owner = project.owner or {}
+        self.created_version = project.created_version
+        self.label_config = project.label_config
+        self.is_visual_ner = project_is_visual_ner(
+            user_project.label_config_line
+        )
+        self.allow_delete_completions = user_project.config.get(
+            "allow_delete_completions", False
+        )
+
+    @property
+    def owner_username(self):
+        return self.owner.get("username")
+
+
+class ProjectMetadataCache:
+    """
+    ProjectMetadata by project name, kept for the request in flask.g and
+    for ttl seconds in the process. Project updates must invalidate it.
+    """
+
+    FIELDS = ["project_id", "owner", "created_version", "label_config"]
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self, project_name):
+        project = UserProjects.get_project_by_project_name_if_exists(
+            project_name=project_name, fields=self.FIELDS
+        )
+        if not project:
+            return None
+        return ProjectMetadata(project, Projectai_project(name=project_name))
+
+    def get(self, project_name):
+        request_entries = g.setdefault("project_metadata", {})
+        if project_name in request_entries:
+            return request_entries[project_name]
+
+        now = time.monotonic()
+        with self.lock:
+            expires_at, metadata = self.entries.get(project_name, (0, None))
+        if expires_at <= now:
+            metadata = self.load(project_name)
+            if metadata is not None:
+                with self.lock:
+                    self.entries[project_name] = (now + self.ttl, metadata)
+        request_entries[project_name] = metadata
+        return metadata
+
+    def invalidate(self, project_name=None, project_id=None):
+        with self.lock:
+            for name, (_, metadata) in list(self.entries.items()):
+                if name == project_name or metadata.project_id == project_id:
+                    del self.entries[name]
+        if has_app_context():
+            g.pop("project_metadata", None)
+
+
+project_metadata = ProjectMetadataCache(
+    app.config.get("PROJECT_METADATA_TTL", 30)
+)
+
+
+class TaskAcl:
+    """
+    Who may write to or review the completions of a task
+    """
+
+    def __init__(self, id, assigned_to, reviewers):
+        self.id = id
+        self.assigned_to = frozenset(assigned_to or ())
+        self.reviewers = frozenset(reviewers or ())
+
+    def allows(self, username, owner_or_manager=False):
+        return (
+            owner_or_manager
+            or username in self.assigned_to
+            or username in self.reviewers
+        )
+
+
+class TaskAclCache:
+    """
+    TaskAcl by (project_id, task_id), kept for ttl seconds and evicted least
+    recently used past max_entries. Assignment changes made through the ORM
+    in this process invalidate it; other processes may still serve an old
+    entry until it expires, so writes ask for fresh ones.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, project_id, task_id, fresh=False):
+        return self.get_many(project_id, [task_id], fresh).get(task_id)
+
+    def get_many(self, project_id, task_ids, fresh=False):
+        """
+        :param fresh: reload every task from the database (in one query)
+        return: {task_id: TaskAcl}, tasks that do not exist are left out
+        """
+        if fresh:
+            return self.refresh(project_id, task_ids)
+        now = time.monotonic()
+        acls = {}
+        with self.lock:
+            for task_id in task_ids:
+                expires_at, acl = self.entries.get(
+                    (project_id, task_id), (0, None)
+                )
+                if expires_at > now:
+                    self.entries.move_to_end((project_id, task_id))
+                    acls[task_id] = acl
+        missing = [task_id for task_id in task_ids if task_id not in acls]
+        if missing:
+            acls.update(self.refresh(project_id, missing))
+        return acls
+
+    def refresh(self, project_id, task_ids):
+        """
+        Reload the given tasks in one query, e.g. after bulk assignment
+        """
+        self.invalidate(project_id, task_ids)
+        acls = {
+            row.task_id: TaskAcl(row.id, row.assigned_to, row.reviewers)
+            for row in Completions.get_tasks_acl(project_id, list(task_ids))
         }
-        if item.title:
-            export_json["data"].update({"title": item.title})
-        final_data.append(export_json)
-    return final_data
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for task_id, acl in acls.items():
+                self.entries[(project_id, task_id)] = (expires_at, acl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return acls
+
+    def invalidate(self, project_id=None, task_ids=None):
+        """
+        Drop the given tasks, every task of the project without task_ids,
+        or everything without project_id
+        """
+        with self.lock:
+            if project_id is None:
+                self.entries.clear()
+                return
+            if task_ids is None:
+                keys = [key for key in self.entries if key[0] == project_id]
+            else:
+                keys = [(project_id, task_id) for task_id in task_ids]
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+task_acls = TaskAclCache(
+    app.config.get("TASK_ACL_TTL", 30),
+    app.config.get("TASK_ACL_MAX_ENTRIES", 100000),
+)
+
+
+@event.listens_for(Tasks, "after_update")
+def _invalidate_task_acl(mapper, connection, target):
+    attrs = inspect(target).attrs
+    if (
+        attrs.assigned_to.history.has_changes()
+        or attrs.reviewers.history.has_changes()
+    ):
+        task_acls.invalidate(target.project_id, [target.task_id])
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _invalidate_task_acls(orm_execute_state):
+    # Bulk assignment, e.g. Tasks.query.filter(..).update(..): which tasks
+    # changed is not known here
+    if (
+        orm_execute_state.is_update
+        and orm_execute_state.bind_mapper is inspect(Tasks)
+    ):
+        task_acls.invalidate()
+
+
+class ActiveLearningTrigger:
+    """
+    Runs al_automatic_model_training in a background thread instead of the
+    request. Triggers for a project are coalesced: the threshold is
+    evaluated once, window seconds after the first trigger, however many
+    triggers arrive meanwhile.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        # project_id -> (project_name, due time)
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pid = None
+
+    def schedule(self, project_id, project_name):
+        with self.condition:
+            if project_id not in self.pending:
+                self.pending[project_id] = (
+                    project_name,
+                    time.monotonic() + self.window,
+                )
+                self.condition.notify()
+            # Threads do not survive a fork of the worker process
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(
+                    target=self._run, name="al-trigger", daemon=True
+                )
+                self.thread.start()
+
+    def _next_due(self):
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                project_id, (project_name, due) = min(
+                    self.pending.items(), key=lambda item: item[1][1]
+                )
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                del self.pending[project_id]
+                return project_id, project_name
+
+    def _run(self):
+        while True:
+            project_id, project_name = self._next_due()
+            try:
+                # The app context removes its session when it is torn down
+                with app.app_context():
+                    al_automatic_model_training(project_id, project_name)
+            except Exception:
+                logger.exception(
+                    f"PROJECT_ID={project_id} ACTIVE LEARNING TRIGGER FAILED"
+                )
+
+
+al_trigger = ActiveLearningTrigger(app.config.get("AL_TRIGGER_WINDOW", 30))
+
+
+def schedule_al_training(project_id, project_name):
+    al_trigger.schedule(project_id, project_name)
 
 
 def identify_config_type(data):
@@ -89,26 +1114,24 @@ def identify_config_type(data):
 
 
 def update_completions_meta_table(project_id, **kwargs):
-    # Handle for older projects created before < 260
-    project = UserProjects.get_project_by_project_id(
-        project_id, ["created_version"]
-    )
-    if not project.created_version:
-        return
+    if kwargs.get("label_config"):
+        # Compiled configs of the previous label config are stale
+        label_configs.invalidate(project_id)
+        project_metadata.invalidate(project_id=project_id)
 
-    db_entry = CompletionsMeta.read(project_id)
+        # Handle for older projects created before < 260
+        project = UserProjects.get_project_by_project_id(
+            project_id, ["created_version"]
+        )
+        if not project.created_version:
+            return
 
-    if kwargs.get("label_config"):
-        from_name_to_name_type = list()
-        parsed_config = parse_config(kwargs["label_config"])
-        for from_name, to in parsed_config.items():
-            from_name_to_name_type.append(
-                {
-                    "from_name": from_name,
-                    "to_name": to["to_name"][0],
-                    "type": to["type"].lower(),
-                }
-            )
+        db_entry = CompletionsMeta.read(project_id)
+        compiled = label_configs.get(project_id, kwargs["label_config"])
+        from_name_to_name_type = [
+            {"from_name": from_name, "to_name": to_name, "type": type_}
+            for from_name, to_name, type_ in sorted(compiled.tuples)
+        ]
         if not db_entry:
             CompletionsMeta(project_id, from_name_to_name_type).save()
         else:
@@ -116,43 +1139,86 @@ def update_completions_meta_table(project_id, **kwargs):
             db_entry.save()
 
     elif kwargs.get("new_completion"):
-        existing_info = db_entry.used_labels_info
-        logger.debug(f"used_labels_info before db update: {existing_info}")
-        new_info = get_labels_info(kwargs["new_completion"])
-        logger.debug(f"new_info parsed from new_completion: {new_info}")
-        merged_info = merge_labels_info(existing_info, new_info, "add")
-        logger.debug(f"used_labels_info after db update: {merged_info}")
-        CompletionsMeta.update(project_id, {"used_labels_info": merged_info})
+        apply_labels_delta(project_id, added=kwargs["new_completion"])
 
     elif kwargs.get("deleted_completion"):
-        existing_info = db_entry.used_labels_info
-        logger.debug(f"used_labels_info before db update: {existing_info}")
-        delete_info = get_labels_info(kwargs["deleted_completion"])
-        logger.debug(
-            f"delete_info parsed from deleted_completion: {delete_info}"
-        )
-        delete_labels_info(existing_info, delete_info)
-        logger.debug(f"used_labels_info after db update: {existing_info}")
-        CompletionsMeta.update(project_id, {"used_labels_info": existing_info})
+        apply_labels_delta(project_id, removed=kwargs["deleted_completion"])
 
     elif kwargs.get("updated_completion"):
-        existing_info = db_entry.used_labels_info
-        logger.debug(f"used_labels_info before db update: {existing_info}")
-        old_info = get_labels_info(kwargs["updated_completion"]["old"])
-        logger.debug(f"old_info parsed from old_completion: {old_info}")
-        merged_info = merge_labels_info(existing_info, old_info, "sub")
-        logger.debug(
-            "merged_info after merging used_labels_info and old_info: "
-            f"{merged_info}"
+        apply_labels_delta(
+            project_id,
+            added=kwargs["updated_completion"]["new"],
+            removed=kwargs["updated_completion"]["old"],
         )
-        new_info = get_labels_info(kwargs["updated_completion"]["new"])
-        merged_info = merge_labels_info(merged_info, new_info, "add")
-        logger.debug(
-            "merged_info after merging merged_info and new_info: "
-            f"{merged_info}"
+
+
+def labels_delta(added_info: dict, removed_info: dict):
+    """
+    Difference of two get_labels_info results as rows for
+    CompletionsMeta.increment_used_labels_info
+    """
+    totals = defaultdict(int)
+    for info, sign in ((added_info, 1), (removed_info, -1)):
+        for from_name, values in info.items():
+            for label, count in values.items():
+                totals[(from_name, label)] += sign * count
+    return [
+        {"from_name": from_name, "label": label, "count": count}
+        for (from_name, label), count in sorted(totals.items())
+        if count
+    ]
+
+
+def apply_labels_delta(project_id, added: list = [], removed: list = []):
+    """
+    Update used_labels_info for completions added and removed, in one
+    atomic statement however many completions are given
+    """
+    delta = labels_delta(get_labels_info(added), get_labels_info(removed))
+    logger.debug(f"used_labels_info delta: {delta}")
+    CompletionsMeta.increment_used_labels_info(project_id, delta)
+
+
+@app.cli.command("check-labels-info")
+@click.argument("project_ids", nargs=-1, type=int)
+@click.option("--fix", is_flag=True, help="Overwrite drifted counts")
+def check_labels_info(project_ids, fix):
+    """
+    Compare used_labels_info with the labels of the completions not
+    deleted, for the given projects (default: all)
+    """
+    query = CompletionsMeta.query.filter(
+        CompletionsMeta.used_labels_info != None
+    )
+    if project_ids:
+        query = query.filter(CompletionsMeta.project_id.in_(project_ids))
+    for db_entry in query.all():
+        expected = count_labels_info(db_entry.project_id)
+        stored = {
+            name: values
+            for name, values in (db_entry.used_labels_info or {}).items()
+            if values
+        }
+        if stored == expected:
+            continue
+        logger.warning(
+            f"PROJECT_ID={db_entry.project_id} used_labels_info drifted: "
+            f"{labels_delta(expected, stored)}"
         )
-        logger.debug(f"used_labels_info after db update: {merged_info}")
-        CompletionsMeta.update(project_id, {"used_labels_info": merged_info})
+        if fix:
+            CompletionsMeta.update(
+                db_entry.project_id, {"used_labels_info": expected}
+            )
+
+
+def count_labels_info(project_id):
+    """
+    used_labels_info recounted from the completions of the project
+    """
+    info = {}
+    for payloads in CompletionItems.iter_payloads(project_id):
+        info = merge_labels_info(info, get_labels_info(payloads), "add")
+    return info
 
 
 def get_labels_info(completions):
@@ -206,21 +1272,47 @@ def delete_labels_info(existing_info, delete_info):
                 existing_info[name].pop(value)
 
 
+def filter_copied_result(result: list, confidence_range, data_type):
+    """
+    Result items of a copied completion or prediction whose confidence is
+    in confidence_range, with the relations between kept items. Items
+    without confidence count as 0 and, when kept, get 1 (completion) or 0
+    (prediction).
+    """
+    low, high = confidence_range
+    kept_ids = set()
+    kept = []
+    for item in result:
+        value = item.get("value")
+        if value and low <= float(value.get("confidence") or 0) <= high:
+            if value.get("confidence") is None and low == 0:
+                confidence = 1 if data_type == "completion" else 0
+                item = {**item, "value": {**value, "confidence": confidence}}
+            kept_ids.add(item.get("id"))
+            kept.append((item, False))
+        elif item.get("direction"):
+            kept.append((item, True))
+    return [
+        item
+        for item, is_relation in kept
+        if not is_relation
+        or (item.get("from_id") in kept_ids and item.get("to_id") in kept_ids)
+    ]
+
+
 def validate_completion_data(completion, config):
     # No need to validate for setting/unsetting ground truth option
     if list(completion.keys()) == ["honeypot"]:
         return
 
     must_have_keys = ["from_name", "to_name", "type", "value"]
-    completion_tuples_in_config = set()
+    if not isinstance(config, CompiledLabelConfig):
+        # Parsed config dict, e.g. Projectai_project.parsed_label_config
+        config = CompiledLabelConfig.from_parsed(config)
     if completion.get("lead_time") and not isinstance(
         completion["lead_time"], int
     ):
         return "lead_time should be integer"
-    for from_name, to in config.items():
-        completion_tuples_in_config.add(
-            (from_name, to["to_name"][0], to["type"].lower())
-        )
     if "result" not in completion or not isinstance(
         completion["result"], list
     ):
@@ -235,7 +1327,7 @@ def validate_completion_data(completion, config):
             result["from_name"],
             result["to_name"],
             result["type"],
-        ) not in completion_tuples_in_config:
+        ) not in config.tuples:
             return (
                 "from_name|to_name|type should be according to the "
                 "defined config"
@@ -250,5 +1342,5 @@ def validate_completion_data(completion, config):
             ):
                 return "start/end indexes should be integer"
         label = result["value"][result["type"]][0].strip()
-        if label not in config[result["from_name"]]["labels"]:
+        if label not in config.labels[result["from_name"]]:
             return f"Invalid {result['type']}: {label}"
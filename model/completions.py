@@ -1,14 +1,34 @@
-import operator
-from sqlalchemy import func, distinct, or_
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import (
+    DDL,
+    bindparam,
+    event,
+    func,
+    distinct,
+    inspect,
+    literal_column,
+    or_,
+    true,
+    tuple_,
+    update,
+)
 from sqlalchemy.orm import load_only
-from sqlalchemy.dialects.postgresql import JSON, JSONB
+from sqlalchemy.dialects.postgresql import JSON, JSONB, insert
 from ai_project.db import db
 from ai_project.models import tasks
 from ai_project.models import tags as TAGS
 from ai_project.models import user_projects
+from ai_project.utils.labeling_config import parse_config
 from sqlalchemy import cast, text
 from lxml import etree
 
+# Tasks read at once when derived tables are rebuilt from Completions
+REBUILD_BATCH_SIZE = 500
+
 
 class Completions(db.Model):
     # primary key of tasks table
@@ -23,12 +43,45 @@ class Completions(db.Model):
     completion_id = db.Column(db.Integer, nullable=False)
     data = db.Column(JSON)
     title = db.Column(db.String(70), default="")
-    completions = db.Column(JSON)
-    predictions = db.Column(JSON)
+    completions = db.Column(JSONB)
+    predictions = db.Column(JSONB)
     created_at = db.Column(
         db.DateTime(timezone=True), server_default=func.now()
     )
     created_by = db.Column(db.String(100), nullable=False)
+    # Last write to completions or predictions, for incremental exports
+    modified_at = db.Column(
+        db.DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False,
+    )
+    # Generated from completions for ground truth exports and counts
+    has_honeypot = db.Column(
+        db.Boolean,
+        db.Computed(
+            "jsonb_path_exists(completions, "
+            "'$[*] ? (@.honeypot == true || @.honeypot == \"true\")')",
+            persisted=True,
+        ),
+    )
+
+    __table_args__ = (
+        db.Index(
+            "ix_completions_project_honeypot",
+            "project_id",
+            "completion_id",
+            postgresql_where=text("has_honeypot"),
+        ),
+        db.Index(
+            "ix_completions_project_modified_at", "project_id", "modified_at"
+        ),
+        db.Index(
+            "ix_completions_project_completion_id",
+            "project_id",
+            "completion_id",
+        ),
+    )
 
     def __init__(
         self,
@@ -58,109 +111,75 @@ class Completions(db.Model):
         Get completions based on project id and task_ids
         return: [(id, created_ago, updated_at, created_username, updated_by),]
         """
-        sub_query = (
-            db.session.query(
-                Completions.completion_id,
-                func.json_array_elements(Completions.completions)
-                .op("->>")("created_ago")
-                .label("created_ago"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("updated_at")
-                .label("updated_at"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("created_username")
-                .label("created_username"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("updated_by")
-                .label("updated_by"),
-            )
-            .filter(
-                Completions.project_id == project_id,
-                Completions.completion_id.in_(task_ids),
-            )
-            .subquery()
+        return CompletionItems.get_task_completion(project_id, task_ids)
+
+    @classmethod
+    def unnested(cls, source: str = "completions", with_results=False):
+        """
+        Query over the elements of completions (or predictions), each array
+        unnested once through a LATERAL join instead of one set-returning
+        call per projected field.
+        :param source: "completions" or "predictions"
+        :param with_results: also unnest the "result" of every element
+        return: (query, element, result) where element and result are the
+        jsonb values to project from (result is None without with_results)
+        """
+        element = (
+            func.jsonb_array_elements(getattr(cls, source))
+            .table_valued("value")
+            .lateral("element")
         )
+        query = db.session.query(cls).join(element, true())
+        if not with_results:
+            return query, element.c.value, None
 
-        query = (
-            db.session.query(sub_query)
-            .with_entities(
-                sub_query.c.completion_id,
-                func.array_remove(
-                    func.array_agg(distinct(sub_query.c.created_username)),
-                    None,
-                ).label("created_username"),
-                func.array_remove(
-                    func.array_agg(distinct(sub_query.c.updated_by)), None
-                ).label("updated_by"),
-                func.max(sub_query.c.created_ago).label("created_ago"),
-                func.max(sub_query.c.updated_at).label("updated_at"),
+        result = (
+            func.jsonb_array_elements(
+                func.coalesce(
+                    element.c.value.op("->")("result"), cast("[]", JSONB)
+                )
             )
-            .group_by(sub_query.c.completion_id)
-            .all()
+            .table_valued("value")
+            .lateral("result")
         )
-
-        return query
+        query = query.join(result, true())
+        return query, element.c.value, result.c.value
 
     @classmethod
     def get_completion_result_detail(cls, project_id: int):
         """
-        Get completions result details for output schema.
+        Get completions result details for output schema, one row per
+        distinct (from_name, to_name, type, value shape).
         :param project_id: Project ID
         return: [(from_name, to_name, type, value),]
         """
-        sub_query = (
-            db.session.query(
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(
-                        func.cast(Completions.completions, JSONB)
-                    ).op("->")("result")
-                )
-                .op("->")("from_name")
-                .label("from_name"),
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(
-                        func.cast(Completions.completions, JSONB)
-                    ).op("->")("result")
-                )
-                .op("->")("to_name")
-                .label("to_name"),
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(
-                        func.cast(Completions.completions, JSONB)
-                    ).op("->")("result")
-                )
-                .op("->")("type")
-                .label("type"),
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(
-                        func.cast(Completions.completions, JSONB)
-                    ).op("->")("result")
-                )
-                .op("->")("value")
-                .label("value"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("deleted_at")
-                .label("deleted_at"),
-            )
-            .filter(
-                Completions.project_id == project_id,
-            )
-            .subquery()
-        )
+        return OutputSchemaTuples.read(project_id)
 
-        query = (
-            cls.query.with_entities(
-                sub_query.c.from_name,
-                sub_query.c.to_name,
-                sub_query.c.type,
-                sub_query.c.value,
-            )
-            .filter(sub_query.c.deleted_at == None)
-            .all()
+    @classmethod
+    def scan_completion_result_detail(cls, project_id: int):
+        """
+        Query over every result of every completion of the project, read
+        from Completions.completions. Results without from_name or to_name
+        (relation, pairwise) are left out, as in OutputSchemaTuples.
+        return: query of (from_name, to_name, type, value)
+        """
+        query, completion, result = cls.unnested(with_results=True)
+        from_name = result.op("->>")("from_name")
+        to_name = result.op("->>")("to_name")
+        config_type = result.op("->>")("type")
+        return query.with_entities(
+            from_name.label("from_name"),
+            to_name.label("to_name"),
+            config_type.label("type"),
+            result.op("->")("value").label("value"),
+        ).filter(
+            cls.project_id == project_id,
+            completion.op("->>")("deleted_at") == None,
+            from_name != None,
+            to_name != None,
+            config_type != None,
         )
 
-        return query
-
     def save(self):
         db.session.add(self)
         db.session.commit()
@@ -171,20 +190,31 @@ class Completions(db.Model):
 
     @classmethod
     def get_completions_count(cls, project_id):
-        return (
-            db.session.query(cls)
-            .filter(
-                cls.project_id == project_id,
-                cls.completions.cast(db.String) != "[]",
-            )
-            .count()
-        )
+        return CompletionCounters.read(project_id).tasks_with_completions
 
     @classmethod
     def get_completions(
         cls, project_id: int, tags: list, ground_truth: bool, fields: list
     ):
-        query = db.session.query(Completions)
+        return cls.get_completions_query(project_id, tags, ground_truth).all()
+
+    @classmethod
+    def get_completions_query(
+        cls,
+        project_id: int,
+        tags: list,
+        ground_truth: bool,
+        fields=None,
+        since=None,
+    ):
+        """
+        Query behind get_completions, for callers that stream the rows.
+        With fields, rows are plain tuples and stay out of the session.
+        :param since: only tasks modified after this timestamp
+        """
+        query = db.session.query(*(fields or [Completions]))
+        if since is not None:
+            query = query.filter(Completions.modified_at > since)
 
         if tags:
             query = query.join(
@@ -192,111 +222,405 @@ class Completions(db.Model):
             ).filter(tasks.TaggedTasks.tag_id.in_(tags))
 
         if ground_truth:
-            completion_subquery = (
-                db.session.query(
-                    Completions.completion_id,
-                    func.json_array_elements(Completions.completions)
-                    .op("->>")("honeypot")
-                    .label("honeypot"),
-                )
-                .filter(Completions.project_id == project_id)
-                .subquery()
-            )
-            query = query.filter(
-                completion_subquery.c.honeypot == "true",
-                completion_subquery.c.completion_id
-                == Completions.completion_id,
-            )
+            query = query.filter(Completions.has_honeypot == True)
 
-        return query.filter(Completions.project_id == project_id).all()
+        return query.filter(Completions.project_id == project_id)
 
     @classmethod
-    def get_al_completions_count(
-        cls, project_id: int, tags: list, completions_filter: str
+    def get_task_id_range(cls, project_id: int, with_tasks: bool = False):
+        """
+        Lowest and highest task id of the project, for sharding exports
+        :param with_tasks: count tasks without completions as well
+        """
+        task_id = tasks.Tasks.task_id if with_tasks else cls.completion_id
+        model = tasks.Tasks if with_tasks else cls
+        return (
+            db.session.query(func.min(task_id), func.max(task_id))
+            .filter(model.project_id == project_id)
+            .one()
+        )
+
+    @classmethod
+    def get_completion_ids(
+        cls,
+        project_id: int,
+        after_id: int = None,
+        limit: int = None,
+        ranges: bool = False,
     ):
-        completions_type = (
-            "review_status"
-            if completions_filter == "reviewed"
-            else "submitted_at"
+        """
+        Sorted completion ids (task ids) of the project, walking the
+        (project_id, completion_id) index from after_id. Only tasks with
+        completion items count, as in get_completions_count: rows of tasks
+        with predictions only are left out.
+        :param ranges: return [start, end] runs of consecutive ids instead,
+        grouped in the database
+        """
+        ensure_project_totals_committed(project_id)
+        query = db.session.query(cls.completion_id.label("id")).filter(
+            cls.project_id == project_id,
+            db.session.query(CompletionItems.task_pk)
+            .filter(CompletionItems.task_pk == cls.id)
+            .exists(),
         )
+        if after_id is not None:
+            query = query.filter(cls.completion_id > after_id)
+        query = query.order_by(cls.completion_id).limit(limit)
+        if not ranges:
+            return [id for id, in query]
+
+        ids = query.subquery()
+        # Consecutive ids share id - position
+        position = func.row_number().over(order_by=ids.c.id)
+        run = db.session.query(
+            ids.c.id, (ids.c.id - position).label("run")
+        ).subquery()
+        return [
+            [start, end]
+            for start, end in db.session.query(
+                func.min(run.c.id), func.max(run.c.id)
+            )
+            .group_by(run.c.run)
+            .order_by(func.min(run.c.id))
+        ]
 
-        completion_subquery = (
+    @classmethod
+    def get_tasks_with_completions_query(
+        cls, project_id: int, tags: list, since=None
+    ):
+        """
+        All tasks of the project with their completions, if any.
+        Streaming counterpart of Tasks.get_all_tasks_with_completions.
+        :param since: only tasks created or modified after this timestamp
+        """
+        query = (
             db.session.query(
+                Completions.completions,
+                Completions.predictions,
+                tasks.Tasks.created_at,
+                tasks.Tasks.created_by,
+                tasks.Tasks.data,
+                tasks.Tasks.title,
                 Completions.completion_id,
-                Completions.id,
-                Completions.project_id,
-                func.json_array_elements(Completions.completions)
-                .op("->>")("honeypot")
-                .label("honeypot"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")(completions_type)
-                .label("completions_type"),
+                tasks.Tasks.task_id,
             )
-            .filter(Completions.project_id == project_id)
-            .subquery()
+            .select_from(tasks.Tasks)
+            .outerjoin(Completions, Completions.id == tasks.Tasks.id)
         )
+        if tags:
+            query = query.join(
+                tasks.TaggedTasks, tasks.Tasks.id == tasks.TaggedTasks.task_pk
+            ).filter(tasks.TaggedTasks.tag_id.in_(tags))
+        if since is not None:
+            query = query.filter(
+                or_(
+                    Completions.modified_at > since,
+                    tasks.Tasks.created_at > since,
+                )
+            )
+        return query.filter(tasks.Tasks.project_id == project_id)
 
-        completion_query = (
-            db.session.query(completion_subquery)
-            .filter(
-                completion_subquery.c.honeypot == "true",
-                completion_subquery.c.completions_type != None,
+    @classmethod
+    def get_tasks_acl(cls, project_id: int, task_ids: list):
+        """
+        Task pk, assignees and reviewers of many tasks, in one query
+        return: [(task_id, id, assigned_to, reviewers),]
+        """
+        return (
+            db.session.query(
+                tasks.Tasks.task_id,
+                tasks.Tasks.id,
+                tasks.Tasks.assigned_to,
+                tasks.Tasks.reviewers,
             )
-            .with_entities(
-                completion_subquery.c.project_id,
-                completion_subquery.c.completion_id,
-                completion_subquery.c.id,
+            .filter(
+                tasks.Tasks.project_id == project_id,
+                tasks.Tasks.task_id.in_(task_ids),
             )
+            .all()
         )
-        if tags:
-            subquery = db.session.query(TAGS.Tags.tag_id).filter(
-                TAGS.Tags.project_id == project_id,
-                TAGS.Tags.tag_name.in_(tags),
-            )
-            completion_query = completion_query.join(
-                tasks.TaggedTasks,
-                completion_subquery.c.id == tasks.TaggedTasks.task_pk,
-            ).filter(tasks.TaggedTasks.tag_id.in_(subquery))
-
-        return completion_query.filter(
-            completion_subquery.c.project_id == project_id
-        ).count()
 
     @classmethod
-    def get_completion_owner_submitted_timestamp(
-        cls, project_id: int, task_id: int, completion_id: int
+    def get_copy_sources(
+        cls,
+        project_id: int,
+        task_ids: list,
+        data_type: str = "prediction",
+        cid: int = None,
     ):
-        completion_subquery = (
+        """
+        The completion or prediction to copy of each task, picked in the
+        database so only that element is loaded
+        Soft deleted completions are never picked.
+        :param cid: id of the element, the last one of each task if None
+        return: {task_id: (id, element)}
+        """
+        column = (
+            cls.completions if data_type == "completion" else cls.predictions
+        )
+        not_deleted = "(!(exists(@.deleted_at)) || @.deleted_at == null)"
+        if cid is None:
+            element = func.jsonb_path_query_array(
+                column, literal_column(f"'$[*] ? {not_deleted}'::jsonpath")
+            ).op("->")(-1)
+        else:
+            element = func.jsonb_path_query_first(
+                column,
+                literal_column(
+                    f"'$[*] ? (@.id == $cid && {not_deleted})'::jsonpath"
+                ),
+                cast(json.dumps({"cid": cid}), JSONB),
+            )
+        rows = (
             db.session.query(
-                func.json_array_elements(Completions.completions)
-                .op("->>")("id")
-                .label("id"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("created_username")
-                .label("created_username"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("submitted_at")
-                .label("submitted_at"),
+                cls.completion_id, cls.id, element.label("element")
             )
             .filter(
-                Completions.project_id == project_id,
-                Completions.completion_id == task_id,
+                cls.project_id == project_id,
+                cls.completion_id.in_(task_ids),
+            )
+            .all()
+        )
+        return {row.completion_id: (row.id, row.element) for row in rows}
+
+    @classmethod
+    def add_completions(
+        cls, project_id: int, created_by: str, task_completions: dict
+    ):
+        """
+        Append new completions to many tasks in one transaction, with ids
+        and ground truth given by add_new_completion
+        :param task_completions: {id: (task_id, [completion,])}
+        return: {id: [completion ids]}
+        """
+        rows = {
+            row.id: row
+            for row in cls.query.filter(cls.id.in_(list(task_completions)))
+            .with_for_update()
+            .all()
+        }
+        missing = [pk for pk in task_completions if pk not in rows]
+        task_data = dict(
+            db.session.query(tasks.Tasks.id, tasks.Tasks.data)
+            .filter(tasks.Tasks.id.in_(missing))
+            .all()
+            if missing
+            else []
+        )
+        completion_ids = {}
+        for task_pk, (task_id, completions) in task_completions.items():
+            row = rows.get(task_pk)
+            if row is None:
+                row = cls(
+                    task_id,
+                    task_pk,
+                    project_id,
+                    task_data.get(task_pk),
+                    [],
+                    [],
+                    created_by,
+                )
+                db.session.add(row)
+            existing = list(row.completions or [])
+            for completion in completions:
+                add_new_completion(task_id, existing, completion)
+            completion_ids[task_pk] = [c["id"] for c in completions]
+            row.completions = existing
+        db.session.commit()
+        return completion_ids
+
+    @classmethod
+    def apply_result_delta(
+        cls,
+        task_pk: int,
+        completion_id: int,
+        added: list,
+        removed: list,
+        changed: list,
+        fields: dict,
+        version: int = None,
+    ):
+        """
+        Apply result items added, removed (by id) and changed (by id) to
+        one completion in place. Relations to removed items are removed.
+        return: (old items, new items, new version), None if there is no
+        such completion. Raises VersionConflict if version is given and
+        the completion is at another version, UnknownResultItems if a
+        changed item is not in the completion.
+        """
+        row = (
+            cls.query.options(
+                load_only(
+                    cls.id, cls.project_id, cls.completion_id, cls.completions
+                )
             )
-            .subquery()
+            .filter(cls.id == task_pk)
+            .with_for_update()
+            .first()
+        )
+        completions = list(row.completions or []) if row else []
+        index = next(
+            (
+                index
+                for index, completion in enumerate(completions)
+                if completion.get("id") == completion_id
+            ),
+            None,
         )
+        if index is None:
+            db.session.rollback()
+            return None
+        current_version = completions[index].get("version", 0)
+        if version is not None and version != current_version:
+            db.session.rollback()
+            raise VersionConflict(completion_id)
+
+        removed_ids = set(removed) - {None}
+        changed_by_id = {item.get("id"): item for item in changed}
+        old_items, result = [], []
+        for item in completions[index].get("result", []):
+            if removed_ids.intersection(
+                (item.get("id"), item.get("from_id"), item.get("to_id"))
+            ):
+                old_items.append(item)
+            elif item.get("id") in changed_by_id:
+                old_items.append(item)
+                result.append(changed_by_id.pop(item["id"]))
+            else:
+                result.append(item)
+        if changed_by_id:
+            db.session.rollback()
+            raise UnknownResultItems(sorted(map(str, changed_by_id)))
+        result.extend(added)
+
+        completions[index] = {
+            **completions[index],
+            **fields,
+            "result": result,
+            "version": current_version + 1,
+        }
+        row.completions = completions
+        db.session.commit()
+        return old_items, [*changed, *added], current_version + 1
 
-        data = (
-            db.session.query(Completions, completion_subquery)
+    @classmethod
+    def get_tasks_for_import(cls, project_id: int, task_ids: list):
+        """
+        Existing tasks an import overwrites, with their current completions
+        return: {task_id: (id, completions)}
+        """
+        if not task_ids:
+            return {}
+        rows = (
+            db.session.query(
+                tasks.Tasks.task_id, tasks.Tasks.id, cls.completions
+            )
+            .outerjoin(cls, cls.id == tasks.Tasks.id)
             .filter(
-                completion_subquery.c.id == str(completion_id),
+                tasks.Tasks.project_id == project_id,
+                tasks.Tasks.task_id.in_(task_ids),
             )
-            .with_entities(
-                completion_subquery.c.created_username,
-                completion_subquery.c.submitted_at,
+            .all()
+        )
+        return {row.task_id: row for row in rows}
+
+    @classmethod
+    def insert_tasks(cls, project_id: int, rows: list):
+        """
+        Create task rows with one multi-row INSERT. Their task ids follow
+        the highest one of the project, read under a per project advisory
+        lock held until commit, so concurrent imports get distinct ids.
+        return: {task_id: id}
+        """
+        if not rows:
+            return {}
+        db.session.execute(
+            db.select(
+                func.pg_advisory_xact_lock(
+                    func.hashtext(tasks.Tasks.__tablename__), project_id
+                )
             )
-            .first()
         )
-        return data
+        last_task_id = (
+            db.session.query(func.max(tasks.Tasks.task_id))
+            .filter(tasks.Tasks.project_id == project_id)
+            .scalar()
+        )
+        for offset, row in enumerate(rows, start=1):
+            row["task_id"] = (last_task_id or 0) + offset
+        inserted = db.session.execute(
+            insert(tasks.Tasks.__table__)
+            .values(rows)
+            .returning(tasks.Tasks.task_id, tasks.Tasks.id)
+        ).all()
+        return {row.task_id: row.id for row in inserted}
+
+    @classmethod
+    def update_tasks(cls, rows: list):
+        """
+        Overwrite data and title of existing tasks, in one executemany
+        :param rows: [{"task_pk": .., "data": .., "title": ..},]
+        """
+        if not rows:
+            return
+        db.session.execute(
+            update(tasks.Tasks.__table__)
+            .where(tasks.Tasks.id == bindparam("task_pk"))
+            .values(data=bindparam("data"), title=bindparam("title")),
+            rows,
+        )
+
+    @classmethod
+    def upsert_completions(cls, rows: list):
+        """
+        Write imported completions with one multi-row INSERT, replacing the
+        completions and predictions of tasks that already have a row
+        """
+        if not rows:
+            return
+        statement = insert(cls.__table__).values(rows)
+        excluded = statement.excluded
+        written = db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.id],
+                set_={
+                    "data": excluded.data,
+                    "title": excluded.title,
+                    "completions": excluded.completions,
+                    "predictions": excluded.predictions,
+                    "modified_at": func.now(),
+                },
+            ).returning(*cls.sync_columns())
+        ).all()
+        sync_derived_tables(db.session.connection(), written)
+
+    @classmethod
+    def get_watermark(cls, overlap_seconds: int = 0):
+        """
+        Database time to resume incremental exports from. Rows stamped by
+        transactions still running now commit with an older modified_at,
+        so the watermark lags by overlap_seconds and exports may repeat
+        recently modified tasks.
+        """
+        return db.session.query(
+            func.now() - func.make_interval(0, 0, 0, 0, 0, 0, overlap_seconds)
+        ).scalar()
+
+    @classmethod
+    def get_al_completions_count(
+        cls, project_id: int, tags: list, completions_filter: str
+    ):
+        return CompletionCounters.get_al_completions_count(
+            project_id, tags, completions_filter
+        )
+
+    @classmethod
+    def get_completion_owner_submitted_timestamp(
+        cls, project_id: int, task_id: int, completion_id: int
+    ):
+        return CompletionItems.get_completion_owner_submitted_timestamp(
+            project_id, task_id, completion_id
+        )
 
     @classmethod
     def get_completion(cls, task_id):
@@ -317,614 +641,2245 @@ class Completions(db.Model):
 
     @classmethod
     def update_completion(cls, task_id, data):
-        db.session.query(cls).filter_by(id=task_id).update(data)
+        rows = db.session.execute(
+            update(cls.__table__)
+            .where(cls.id == task_id)
+            .values(data)
+            .returning(*cls.sync_columns())
+        ).all()
+        sync_derived_tables(db.session.connection(), rows)
         db.session.commit()
 
     @classmethod
-    def delete_completion(cls, task_id):
-        db.session.query(cls).filter_by(id=task_id).delete()
+    def save_page(
+        cls,
+        task_pk: int,
+        completion_id: int,
+        page_number: int,
+        items: list,
+        fields: dict,
+        version: int = None,
+    ):
+        """
+        Replace the result items of one page of a multi-page document
+        (Visual NER) in a single statement. The document is filtered in
+        the database, so only the page's items and the completion's top
+        level fields travel either way, and only that page's spans are
+        rewritten. Pages are not deleted one by one, so deleted_at is not
+        taken from fields.
+        return: (page items replaced, new version), None if there is no
+        such completion. Raises VersionConflict if version is given and
+        the completion is at another version.
+        """
+        fields = {
+            name: value
+            for name, value in fields.items()
+            if name != "deleted_at"
+        }
+        statement = text(
+            f"""
+            WITH {cls.element_target(version)}, page AS (
+                SELECT coalesce(
+                    jsonb_agg(r.item) FILTER (WHERE r.on_page), '[]'
+                ) AS items,
+                coalesce(
+                    jsonb_agg(r.item) FILTER (WHERE NOT r.on_page), '[]'
+                ) AS other_items
+                FROM target, LATERAL (
+                    SELECT item, coalesce(
+                        item -> 'pageNumber' = to_jsonb(CAST(:page AS int)),
+                        false
+                    ) AS on_page
+                    FROM jsonb_array_elements(
+                        coalesce(target.element -> 'result', '[]')
+                    ) AS item
+                ) AS r
+            ), updated AS (
+                UPDATE {cls.__tablename__} AS c SET
+                    completions = jsonb_set(
+                        c.completions,
+                        ARRAY[CAST(target.idx AS text)],
+                        target.element
+                        || CAST(:fields AS jsonb)
+                        || jsonb_build_object(
+                            'result',
+                            page.other_items || CAST(:items AS jsonb),
+                            'version', target.version + 1
+                        )
+                    ),
+                    modified_at = now()
+                FROM target, page
+                WHERE c.id = target.id
+                RETURNING c.id, c.project_id, c.completion_id,
+                    c.completions -> CAST(target.idx AS int) AS element,
+                    target.element - 'result' AS old_fields,
+                    page.items AS page_items,
+                    target.version + 1 AS version
+            ), {CompletionItems.payload_update("updated")}
+            SELECT id, project_id, completion_id, old_fields,
+                element - 'result' AS fields, page_items, version
+            FROM updated
+            """
+        )
+        rows = db.session.execute(
+            statement,
+            {
+                "task_pk": task_pk,
+                "completion_id": completion_id,
+                "page": page_number,
+                "items": json.dumps(items),
+                "fields": json.dumps(fields),
+                "version": version,
+            },
+        ).all()
+        if not rows:
+            return cls.missing_or_conflict(task_pk, completion_id)
+        row = rows[0]
+        sync_completion_fields(
+            db.session.connection(),
+            row,
+            {**row.old_fields, "result": row.page_items},
+            {**row.fields, "result": items},
+            page_number,
+        )
         db.session.commit()
+        return row.page_items, row.version
 
     @classmethod
-    def get_completion_review_status(
-        cls, project_id: int, task_id: int, completion_id: int
+    def update_completion_element(
+        cls, task_pk: int, completion_id: int, changes: dict, version=None
     ):
         """
-        Get completion review status
+        Merge changes into one completion of the task and bump its version,
+        in a single statement
+        return: (completion before the change, new version), None if there
+        is no such completion. Raises VersionConflict if version is given
+        and the completion is at another version.
         """
-        completion_subquery = (
-            db.session.query(
-                func.json_array_elements(Completions.completions)
-                .op("->>")("id")
-                .label("id"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("review_status")
-                .label("review_status"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("submitted_at")
-                .label("submitted_at"),
-            )
-            .filter(
-                Completions.project_id == project_id,
-                Completions.completion_id == task_id,
-            )
-            .subquery()
+        statement = text(
+            f"""
+            WITH {cls.element_target(version)}
+            UPDATE {cls.__tablename__} AS c SET
+                completions = jsonb_set(
+                    c.completions,
+                    ARRAY[CAST(target.idx AS text)],
+                    target.element
+                    || CAST(:changes AS jsonb)
+                    || jsonb_build_object('version', target.version + 1)
+                ),
+                modified_at = now()
+            FROM target
+            WHERE c.id = target.id
+            RETURNING c.id, c.project_id, c.completion_id,
+                c.completions -> CAST(target.idx AS int) AS element,
+                target.element AS old_element,
+                target.version + 1 AS version
+            """
         )
-
-        review_status = (
-            db.session.query(Completions, completion_subquery)
-            .filter(
-                completion_subquery.c.id == str(completion_id),
-            )
-            .with_entities(
-                completion_subquery.c.review_status,
-                completion_subquery.c.submitted_at,
-            )
-            .first()
+        rows = db.session.execute(
+            statement,
+            {
+                "task_pk": task_pk,
+                "completion_id": completion_id,
+                "changes": json.dumps(changes),
+                "version": version,
+            },
+        ).all()
+        if not rows:
+            return cls.missing_or_conflict(task_pk, completion_id)
+        row = rows[0]
+        # Only this completion changed: neither the task's other
+        # completions nor its predictions are read back or rewritten
+        sync_completion_changes(
+            db.session.connection(),
+            [ElementChange(row, row.old_element, row.element)],
         )
-        return review_status
+        db.session.commit()
+        return row.old_element, row.version
 
     @classmethod
-    def get_user_completions(
-        cls, project_id: int, task_id: int, username: str
+    def set_completion_fields(
+        cls,
+        task_pk: int,
+        completion_id: int,
+        fields: dict,
+        version=None,
+        condition: str = "",
     ):
-        completion_subquery = (
-            db.session.query(
-                Completions.completions,
-                func.json_array_elements(Completions.completions)
-                .op("->>")("created_username")
-                .label("created_username"),
-                func.json_array_elements(Completions.completions)
-                .op("->>")("updated_by")
-                .label("updated_by"),
-            )
-            .filter(
-                Completions.project_id == project_id,
-                Completions.completion_id == task_id,
+        """
+        Set top level fields of one completion in place with jsonb_set and
+        bump its version, in a single statement. condition is extra SQL on
+        the completion (e.element) that has to hold. Only the completion's
+        fields travel back, its result only when fields set deleted_at.
+        return: (result before the change, or [] without deleted_at, new
+        version), None if there is no such completion. Raises
+        VersionConflict if the completion is at another version or does
+        not meet condition.
+        """
+        params = {
+            "task_pk": task_pk,
+            "completion_id": completion_id,
+            "version": version,
+        }
+        completions = "c.completions"
+        values = [
+            (f":name_{index}", f"CAST(:value_{index} AS jsonb)")
+            for index in range(len(fields))
+        ]
+        values.append(("'version'", "to_jsonb(target.version + 1)"))
+        for index, (name, value) in enumerate(fields.items()):
+            params[f"name_{index}"] = name
+            params[f"value_{index}"] = json.dumps(value)
+        for name_sql, value_sql in values:
+            completions = (
+                f"jsonb_set({completions}, ARRAY[CAST(target.idx AS text),"
+                f" CAST({name_sql} AS text)], {value_sql})"
             )
-            .subquery()
+        old_result = (
+            "target.element -> 'result'" if "deleted_at" in fields else "NULL"
         )
-
-        completions = (
-            db.session.query(completion_subquery)
-            .filter(
-                or_(
-                    completion_subquery.c.created_username == username,
-                    completion_subquery.c.updated_by == username,
-                ),
-            )
-            .with_entities(completion_subquery.c.completions)
-            .first()
+        statement = text(
+            f"""
+            WITH {cls.element_target(version, condition)}, updated AS (
+                UPDATE {cls.__tablename__} AS c SET
+                    completions = {completions},
+                    modified_at = now()
+                FROM target
+                WHERE c.id = target.id
+                RETURNING c.id, c.project_id, c.completion_id,
+                    c.completions -> CAST(target.idx AS int) AS element,
+                    target.element - 'result' AS old_fields,
+                    {old_result} AS old_result,
+                    target.version + 1 AS version
+            ), {CompletionItems.payload_update("updated")}
+            SELECT id, project_id, completion_id, old_fields,
+                element - 'result' AS fields, old_result, version
+            FROM updated
+            """
         )
+        rows = db.session.execute(statement, params).all()
+        if not rows:
+            return cls.missing_or_conflict(task_pk, completion_id)
+        row = rows[0]
+        old, new = row.old_fields, row.fields
+        if row.old_result is not None:
+            old = {**old, "result": row.old_result}
+            new = {**new, "result": row.old_result}
+        sync_completion_fields(db.session.connection(), row, old, new)
+        db.session.commit()
+        return row.old_result or [], row.version
 
-        return completions
+    @classmethod
+    def set_review_status(
+        cls,
+        task_pk: int,
+        completion_id: int,
+        review_status: dict,
+        version=None,
+    ):
+        """
+        Review a submitted completion that is not reviewed yet. Rejected
+        completions stop being ground truth.
+        """
+        fields = {"review_status": review_status}
+        if review_status.get("approved") is False:
+            fields["honeypot"] = False
+        return cls.set_completion_fields(
+            task_pk,
+            completion_id,
+            fields,
+            version,
+            condition=(
+                "AND coalesce(e.element ->> 'submitted_at', '') <> ''"
+                " AND coalesce(e.element -> 'review_status', 'null')"
+                " IN ('null', '{}')"
+            ),
+        )
 
-    #######################
-    # Charts related method
-    #######################
+    @classmethod
+    def set_honeypot(
+        cls, task_pk: int, completion_id: int, honeypot: bool, version=None
+    ):
+        """
+        Set or unset a completion as ground truth
+        """
+        return cls.set_completion_fields(
+            task_pk, completion_id, {"honeypot": honeypot}, version
+        )
 
     @classmethod
-    def get_completion_result_by_annotator_vner(
-        cls,
-        project_id: int,
-        completion_ids: list = [],
-        username: str = None,
-        **kwargs,
+    def soft_delete_completion(
+        cls, task_pk: int, completion_id: int, deleted_at: str, version=None
     ):
         """
-        Get completion result detail by annotator
-        :For Visual NER project
+        Mark a completion that is not submitted as deleted
         """
+        return cls.set_completion_fields(
+            task_pk,
+            completion_id,
+            {"deleted_at": deleted_at},
+            version,
+            condition="AND coalesce(e.element ->> 'submitted_at', '') = ''",
+        )
 
-        filters = [Completions.project_id == project_id]
+    @classmethod
+    def element_target(cls, version=None, condition: str = ""):
+        """
+        CTE "target" locking the task row and selecting the completion
+        :completion_id of task :task_pk, with its array index and
+        version (0 if it has none). With version, it also has to be at
+        :version.
+        """
+        version_filter = (
+            "AND coalesce(CAST(e.element ->> 'version' AS int), 0)"
+            " = :version"
+            if version is not None
+            else ""
+        )
+        return f"""target AS (
+                SELECT c.id, e.ordinality - 1 AS idx, e.element,
+                coalesce(CAST(e.element ->> 'version' AS int), 0) AS version
+                FROM {cls.__tablename__} AS c,
+                jsonb_array_elements(c.completions)
+                WITH ORDINALITY AS e(element, ordinality)
+                WHERE c.id = :task_pk
+                AND e.element -> 'id' = to_jsonb(CAST(:completion_id AS int))
+                {version_filter}
+                {condition}
+                FOR UPDATE OF c
+            )"""
 
-        if completion_ids:
-            filters.append(Completions.completion_id.in_(list(completion_ids)))
-        subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(
-                    is_completions=True, is_visual_ner=True
+    @classmethod
+    def missing_or_conflict(cls, task_pk: int, completion_id: int):
+        """
+        Tell apart why a conditional write matched nothing
+        """
+        db.session.rollback()
+        exists = (
+            db.session.query(
+                func.jsonb_path_exists(
+                    cls.completions,
+                    literal_column("'$[*] ? (@.id == $id)'::jsonpath"),
+                    cast(json.dumps({"id": completion_id}), JSONB),
                 )
             )
-            .filter(*filters)
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("deleted_at"),
-                text("submitted_at"),
-                text("taskid"),
-                text("username"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
-            )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
+            .filter(cls.id == task_pk)
+            .scalar()
         )
+        if exists:
+            raise VersionConflict(completion_id)
+        return None
 
-        filters = [
-            subquery.c.deleted_at == None,
-            subquery.c.honeypot == "true",
-            subquery.c.submitted_at != None,
-        ]
-
-        if username:
-            filters.append(subquery.c.username == username)
-        fields = []
-        if not username:
-            fields = [subquery.c.username]
+    @classmethod
+    def get_page(cls, task_pk: int, completion_id: int, page_number: int):
+        """
+        Result items of one page of a completion, filtered in the database
+        """
+        path = (
+            "$[*] ? (@.id == $completion_id)"
+            ".result[*] ? (@.pageNumber == $page)"
+        )
+        variables = {"completion_id": completion_id, "page": page_number}
+        return [
+            item
+            for item, in db.session.query(
+                func.jsonb_path_query(
+                    cls.completions,
+                    literal_column(f"'{path}'::jsonpath"),
+                    cast(json.dumps(variables), JSONB),
+                )
+            ).filter(cls.id == task_pk)
+        ]
 
+    @classmethod
+    def sync_columns(cls):
+        """
+        Columns needed by sync_derived_tables, for RETURNING clauses of
+        bulk statements that bypass the ORM flush.
+        """
         return (
-            db.session.query(subquery)
-            .with_entities(
-                subquery.c.label,
-                subquery.c.chunk,
-                subquery.c.taskid,
-                subquery.c.x,
-                subquery.c.y,
-                subquery.c.width,
-                subquery.c.height,
-                *fields,
-            )
-            .filter(*filters)
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("submitted_at"),
-                text("deleted_at"),
-                text("taskid"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
-            )
+            cls.id,
+            cls.project_id,
+            cls.completion_id,
+            cls.completions,
+            cls.predictions,
+        )
+
+    @classmethod
+    def delete_completion(cls, task_id):
+        deleted = (
+            db.session.query(cls.id, cls.project_id, cls.completion_id)
+            .filter(cls.id == task_id)
+            .with_for_update()
             .all()
         )
+        forget_deleted_tasks(db.session.connection(), deleted)
+        db.session.query(cls).filter_by(id=task_id).delete()
+        db.session.commit()
 
     @classmethod
-    def get_completion_result_by_annotator(
+    def get_completion_review_status(
+        cls, project_id: int, task_id: int, completion_id: int
+    ):
+        """
+        Get completion review status
+        """
+        return CompletionItems.get_completion_review_status(
+            project_id, task_id, completion_id
+        )
+
+    @classmethod
+    def get_review_states(cls, project_id: int, keys: list):
+        """
+        Review status and task reviewers of many completions, in one query
+        :param keys: [(task_id, completion_id),]
+        return: {(task_id, completion_id): row}
+        """
+        return CompletionItems.get_review_states(project_id, keys)
+
+    @classmethod
+    def add_reviews(cls, reviews: dict):
+        """
+        Merge review data into many completions in one transaction. Like
+        set_review_status, a completion is only reviewed if it is submitted
+        and not reviewed yet once its row is locked.
+        :param reviews: {id: {completion_id: review_data}}
+        return: {(id, completion_id)} of the reviews not applied
+        """
+        rejected = {
+            (task_pk, completion_id)
+            for task_pk, task_reviews in reviews.items()
+            for completion_id in task_reviews
+        }
+        rows = (
+            cls.query.filter(cls.id.in_(list(reviews)))
+            .with_for_update()
+            .all()
+        )
+        for row in rows:
+            task_reviews = reviews[row.id]
+            completions = []
+            for completion in row.completions or []:
+                review = task_reviews.get(completion.get("id"))
+                if review and is_reviewable(completion):
+                    rejected.discard((row.id, completion["id"]))
+                    version = completion.get("version", 0) + 1
+                    completion = {**completion, **review, "version": version}
+                completions.append(completion)
+            row.completions = completions
+        db.session.commit()
+        return rejected
+
+    @classmethod
+    def get_user_completions(
+        cls, project_id: int, task_id: int, username: str
+    ):
+        return CompletionItems.get_user_completions(
+            project_id, task_id, username
+        )
+
+    #######################
+    # Charts related method
+    #######################
+
+    @classmethod
+    def get_completion_result_by_annotator_vner(
         cls,
         project_id: int,
         completion_ids: list = [],
         username: str = None,
-        is_assertion=None,
+        **kwargs,
     ):
         """
         Get completion result detail by annotator
+        :For Visual NER project
         """
-
-        filters = [Completions.project_id == project_id]
-
+        filters = AnnotationSpans.ground_truth_filters(project_id)
         if completion_ids:
-            filters.append(Completions.completion_id.in_(list(completion_ids)))
-        subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(is_completions=True)
-            )
-            .filter(*filters)
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("deleted_at"),
-                text("submitted_at"),
-                text("taskid"),
-                text("username"),
-                text("start"),
-                text("end_index"),
+            filters.append(
+                AnnotationSpans.task_id.in_(list(completion_ids))
             )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
-        )
+        if username:
+            filters.append(AnnotationSpans.username == username)
 
-        filters = [
-            subquery.c.deleted_at == None,
-            subquery.c.honeypot == "true",
-            subquery.c.submitted_at != None,
-        ]
+        fields = AnnotationSpans.span_fields(is_visual_ner=True)
+        if not username:
+            fields.append(AnnotationSpans.username)
 
-        project = user_projects.UserProjects.get_project_by_project_id(
-            project_id, ["label_config"]
+        return AnnotationSpans.query_spans(
+            fields, filters, group_by=[AnnotationSpans.submitted_at]
         )
-        if is_assertion != None:
-            condition_operator = operator.eq if is_assertion else operator.ne
-            xmlTree = etree.fromstring(project.label_config)
-            assertion_label = [
-                element.get("value")
-                for sh in xmlTree.iter("Labels")
-                for element in sh.iter("Label")
-                if condition_operator(element.get("assertion"), "true")
-            ]
+
+    @classmethod
+    def get_completion_result_by_annotator(
+        cls,
+        project_id: int,
+        completion_ids: list = [],
+        username: str = None,
+        is_assertion=None,
+    ):
+        """
+        Get completion result detail by annotator
+        """
+        filters = AnnotationSpans.ground_truth_filters(project_id)
+        if completion_ids:
             filters.append(
-                cast(subquery.c.label, JSONB).op("->>")(0).in_(assertion_label)
+                AnnotationSpans.task_id.in_(list(completion_ids))
+            )
+
+        if is_assertion != None:
+            project = user_projects.UserProjects.get_project_by_project_id(
+                project_id, ["label_config"]
+            )
+            compiled = label_configs.get(project_id, project.label_config)
+            assertion_label = (
+                compiled.assertion_labels
+                if is_assertion
+                else compiled.plain_labels
             )
+            filters.append(AnnotationSpans.label.in_(assertion_label))
 
         if username:
-            filters.append(subquery.c.username == username)
-
-        fields = [
-            subquery.c.label,
-            subquery.c.chunk,
-            subquery.c.taskid,
-            subquery.c.start,
-            subquery.c.end_index,
-        ]
+            filters.append(AnnotationSpans.username == username)
+
+        fields = AnnotationSpans.span_fields()
         if not username:
-            fields.append(subquery.c.username)
+            fields.append(AnnotationSpans.username)
 
-        return (
-            db.session.query(subquery)
-            .with_entities(*fields)
-            .filter(*filters)
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("submitted_at"),
-                text("deleted_at"),
-                text("taskid"),
-                text("start"),
-                text("end_index"),
-            )
-            .all()
+        return AnnotationSpans.query_spans(
+            fields, filters, group_by=[AnnotationSpans.submitted_at]
         )
 
     # prediction vs ground truth chart
 
     @classmethod
-    def get_completions_result_fields(
-        cls, is_completions: bool = True, is_visual_ner: bool = False
-    ):
+    def get_completions_for_PVGT_vner(cls, project_id: int, task_ids):
         """
-        get completions result fields to extract from database
+        Get completions for prediction vs ground truth chart
+        :For Visual NER Project
         """
+        return AnnotationSpans.query_spans(
+            [
+                AnnotationSpans.username,
+                *AnnotationSpans.span_fields(is_visual_ner=True),
+            ],
+            [
+                *AnnotationSpans.ground_truth_filters(project_id),
+                AnnotationSpans.task_id.in_(list(task_ids)),
+            ],
+            group_by=[AnnotationSpans.submitted_at],
+        )
 
-        request_type = (
-            Completions.completions
-            if is_completions
-            else Completions.predictions
+    @classmethod
+    def get_predictions_for_PVGT_vner(cls, project_id):
+        """
+        Get predictions for prediction vs ground truth chart
+        :For Visual NER Project
+        """
+        return AnnotationSpans.query_spans(
+            [
+                AnnotationSpans.username,
+                *AnnotationSpans.span_fields(is_visual_ner=True),
+            ],
+            AnnotationSpans.prediction_filters(project_id),
         )
-        values = (
-            {
-                "x_px": "x",
-                "y_px": "y",
-                "width_px": "width",
-                "height_px": "height",
-            }
+
+    @classmethod
+    def get_completions_for_PVGT(cls, project_id: int, task_ids):
+        """
+        Get completions for prediction vs ground truth chart
+        """
+        return AnnotationSpans.query_spans(
+            [AnnotationSpans.username, *AnnotationSpans.span_fields()],
+            [
+                *AnnotationSpans.ground_truth_filters(project_id),
+                AnnotationSpans.task_id.in_(list(task_ids)),
+            ],
+            group_by=[AnnotationSpans.submitted_at],
+        )
+
+    @classmethod
+    def get_predictions_for_PVGT(cls, project_id):
+        """
+        Get predictions for prediction vs ground truth chart
+        """
+        return AnnotationSpans.query_spans(
+            [AnnotationSpans.username, *AnnotationSpans.span_fields()],
+            AnnotationSpans.prediction_filters(project_id),
+        )
+
+    @classmethod
+    def get_completion_for_CEBA(cls, project_id, is_visual_ner: bool = False):
+        """
+        Get completions for chunk extracted by annotator chart
+        For: chunk_extracted_by_label, chunk_extracted_by_annotator chart
+        """
+        # Spans are counted per distinct position, across tasks
+        positions = (
+            [
+                AnnotationSpans.x,
+                AnnotationSpans.y,
+                AnnotationSpans.width,
+                AnnotationSpans.height,
+            ]
             if is_visual_ner
-            else {"start": "start", "end": "end_index"}
+            else [AnnotationSpans.start, AnnotationSpans.end_index]
+        )
+        return (
+            db.session.query(
+                AnnotationSpans.username,
+                AnnotationSpans.chunk,
+                AnnotationSpans.label,
+            )
+            .filter(*AnnotationSpans.ground_truth_filters(project_id))
+            .group_by(
+                AnnotationSpans.label,
+                AnnotationSpans.username,
+                AnnotationSpans.chunk,
+                AnnotationSpans.submitted_at,
+                *positions,
+            )
+            .all()
         )
 
-        fields = [
-            func.jsonb_array_elements(
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(cast(request_type, JSONB)).op(
-                        "->"
-                    )("result")
-                )
-                .op("->")("value")
-                .op("->")(
-                    func.jsonb_array_elements(
-                        func.jsonb_array_elements(
-                            cast(request_type, JSONB)
-                        ).op("->")("result")
-                    ).op("->>")("type")
-                )
-            ).label("label"),
-            func.jsonb_array_elements(
-                func.jsonb_array_elements(cast(request_type, JSONB)).op("->")(
-                    "result"
+
+def parse_timestamp(value):
+    """
+    Parse ISO timestamps stored in completions ("2020-07-18T06:17:12Z")
+    """
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def page_of(result: dict):
+    # Only integer page numbers select a page (see Completions.save_page)
+    page = result.get("pageNumber")
+    return page if type(page) is int else None
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def add_new_completion(task_id: int, completions: list, completion: dict):
+    """
+    Append a new completion to the completions of a task the way
+    Projectai_project.save_completion does: its id is task_id * 1000 plus
+    its position, and the first completion of a task is its ground truth.
+    """
+    used = {c.get("id") for c in completions}
+    completion_id = task_id * 1000 + len(completions) + 1
+    while completion_id in used:
+        completion_id += 1
+    completion["id"] = completion_id
+    completion["version"] = 1
+    if not completions:
+        completion["honeypot"] = True
+    completions.append(completion)
+
+
+def is_honeypot(completion: dict):
+    # Imported completions may carry "true" instead of a boolean
+    return completion.get("honeypot") in (True, "true")
+
+
+def is_reviewable(completion: dict):
+    # Submitted and not reviewed yet (see Completions.set_review_status)
+    return bool(completion.get("submitted_at")) and (
+        completion.get("review_status") in (None, {})
+    )
+
+
+class VersionConflict(Exception):
+    """
+    A conditional completion write found the completion at another version
+    """
+
+
+class UnknownResultItems(Exception):
+    """
+    A result delta changes items the completion does not have
+    """
+
+
+class CompiledLabelConfig:
+    """
+    A label config with what validation and charts look up precomputed
+    """
+
+    def __init__(self, parsed: dict, assertion_labels=(), plain_labels=()):
+        self.parsed = parsed
+        self.tuples = frozenset(
+            (from_name, to["to_name"][0], to["type"].lower())
+            for from_name, to in parsed.items()
+        )
+        self.labels = {
+            from_name: frozenset(to.get("labels") or ())
+            for from_name, to in parsed.items()
+        }
+        self.assertion_labels = tuple(assertion_labels)
+        self.plain_labels = tuple(plain_labels)
+
+    @classmethod
+    def compile(cls, label_config: str):
+        assertion_labels, plain_labels = [], []
+        for labels in etree.fromstring(label_config).iter("Labels"):
+            for element in labels.iter("Label"):
+                if element.get("assertion") == "true":
+                    assertion_labels.append(element.get("value"))
+                else:
+                    plain_labels.append(element.get("value"))
+        return cls(
+            parse_config(label_config), assertion_labels, plain_labels
+        )
+
+    @classmethod
+    def from_parsed(cls, parsed: dict):
+        return cls(parsed)
+
+
+class LabelConfigCache:
+    """
+    Compiled label configs keyed by (project_id, config hash), least
+    recently used entries are evicted past max_entries
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(project_id: int, label_config: str):
+        digest = hashlib.sha1(label_config.encode()).hexdigest()
+        return project_id, digest
+
+    def get(self, project_id: int, label_config: str):
+        key = self.key(project_id, label_config)
+        with self.lock:
+            compiled = self.entries.get(key)
+            if compiled is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+        compiled = CompiledLabelConfig.compile(label_config)
+        with self.lock:
+            self.entries[key] = compiled
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return compiled
+
+    def invalidate(self, project_id: int):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == project_id]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+            }
+
+
+label_configs = LabelConfigCache()
+
+
+class CompletionItems(db.Model):
+    """
+    One row per completion of Completions.completions, kept in step with the
+    JSON array so single completion lookups do not have to unnest it.
+    """
+
+    __tablename__ = "completion_items"
+
+    task_pk = db.Column(
+        db.ForeignKey("completions.id", ondelete="CASCADE"), primary_key=True
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # Same as Completions.completion_id
+    task_id = db.Column(db.Integer, nullable=False)
+    created_username = db.Column(db.String(100))
+    submitted_at = db.Column(db.DateTime(timezone=True))
+    # Whether submitted_at is set at all, parsable or not
+    submitted = db.Column(db.Boolean, nullable=False, default=False)
+    honeypot = db.Column(db.Boolean, nullable=False, default=False)
+    deleted_at = db.Column(db.DateTime(timezone=True))
+    # Whether deleted_at is set at all, parsable or not
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    review_status = db.Column(JSONB(none_as_null=True))
+    updated_by = db.Column(db.String(100))
+    # The completion itself, including its result
+    payload = db.Column(JSONB, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_completion_items_project_task", "project_id", "task_id"),
+        db.Index(
+            "ix_completion_items_project_username",
+            "project_id",
+            "created_username",
+        ),
+        db.Index(
+            "ix_completion_items_project_honeypot",
+            "project_id",
+            "honeypot",
+            "submitted",
+        ),
+    )
+
+    @staticmethod
+    def item_of(task_row, completion: dict):
+        return {
+            "task_pk": task_row.id,
+            "id": int(completion["id"]),
+            "project_id": task_row.project_id,
+            "task_id": task_row.completion_id,
+            "created_username": completion.get("created_username"),
+            "submitted_at": parse_timestamp(completion.get("submitted_at")),
+            "submitted": bool(completion.get("submitted_at")),
+            "honeypot": is_honeypot(completion),
+            "deleted_at": parse_timestamp(completion.get("deleted_at")),
+            "deleted": bool(completion.get("deleted_at")),
+            "review_status": completion.get("review_status"),
+            "updated_by": completion.get("updated_by"),
+            "payload": completion,
+        }
+
+    @classmethod
+    def apply(cls, connection, changes: list):
+        """
+        Write the items of changed completions only, one row each
+        """
+        removed = [change.key for change in changes if change.new is None]
+        if removed:
+            connection.execute(
+                cls.__table__.delete().where(
+                    tuple_(cls.task_pk, cls.id).in_(removed)
                 )
             )
-            .op("->")("value")
-            .op("->")("text")
-            .op("->>")(0)
-            .label("chunk"),
-            func.jsonb_array_elements(cast(request_type, JSONB))
-            .op("->>")("created_username")
-            .label("username"),
-            *[
-                func.jsonb_array_elements(
-                    func.jsonb_array_elements(cast(request_type, JSONB)).op(
-                        "->"
-                    )("result")
-                )
-                .op("->")("value")
-                .op("->>")(key)
-                .label(value)
-                for key, value in values.items()
-            ],
-            Completions.completion_id.label("taskid"),
+        items = [
+            cls.item_of(change.task, change.new)
+            for change in changes
+            if change.new is not None
         ]
+        if not items:
+            return
+        statement = insert(cls.__table__).values(items)
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.task_pk, cls.id],
+                set_={
+                    name: statement.excluded[name]
+                    for name in items[0]
+                    if name not in ("task_pk", "id")
+                },
+            )
+        )
 
-        if is_completions:
-            fields = [
-                func.jsonb_array_elements(cast(Completions.completions, JSONB))
-                .op("->")("deleted_at")
-                .label("deleted_at"),
-                func.jsonb_array_elements(cast(Completions.completions, JSONB))
-                .op("->>")("honeypot")
-                .label("honeypot"),
-                func.jsonb_array_elements(cast(Completions.completions, JSONB))
-                .op("->")("submitted_at")
-                .label("submitted_at"),
-            ] + fields
+    @classmethod
+    def update_fields(cls, connection, changes: list):
+        """
+        Write the columns of changed completions whose payload was already
+        written by the statement that changed them
+        """
+        for change in changes:
+            columns = cls.item_of(change.task, change.new)
+            for name in ("task_pk", "id", "project_id", "task_id", "payload"):
+                del columns[name]
+            task_pk, id = change.key
+            connection.execute(
+                update(cls.__table__)
+                .where(cls.task_pk == task_pk, cls.id == id)
+                .values(columns)
+            )
 
-        return fields
+    @classmethod
+    def payload_update(cls, source: str):
+        """
+        CTE "items" writing the payload of the completion :completion_id
+        from the id and element columns of the CTE source, so it is written
+        next to Completions without travelling back
+        """
+        return f"""items AS (
+                UPDATE {cls.__tablename__} AS i SET payload = s.element
+                FROM {source} AS s
+                WHERE i.task_pk = s.id AND i.id = :completion_id
+            )"""
 
     @classmethod
-    def get_completions_for_PVGT_vner(cls, project_id: int, task_ids):
+    def get_payloads(cls, connection, task_pks: list):
         """
-        Get completions for prediction vs ground truth chart
-        :For Visual NER Project
+        Stored completions of the tasks
+        return: {task_pk: [completion,]}
         """
-        completions_subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(
-                    is_completions=True, is_visual_ner=True
-                )
+        payloads = {task_pk: [] for task_pk in task_pks}
+        if not task_pks:
+            return payloads
+        for task_pk, payload in connection.execute(
+            db.select(cls.task_pk, cls.payload).where(
+                cls.task_pk.in_(task_pks)
             )
-            .filter(
-                Completions.project_id == project_id,
-                Completions.completion_id.in_(list(task_ids)),
+        ):
+            payloads[task_pk].append(payload)
+        return payloads
+
+    @classmethod
+    def raw_submitted_at(cls):
+        """
+        submitted_at as stored in the completion, for callers that only
+        need to know whether it is set
+        """
+        return cls.payload.op("->>")("submitted_at").label("submitted_at")
+
+    @classmethod
+    def get_task_completion(cls, project_id: int, task_ids: list):
+        """
+        Get completions based on project id and task_ids
+        return: [(id, created_ago, updated_at, created_username, updated_by),]
+        """
+        ensure_project_totals_committed(project_id)
+        return (
+            db.session.query(
+                cls.task_id.label("completion_id"),
+                func.array_remove(
+                    func.array_agg(distinct(cls.created_username)), None
+                ).label("created_username"),
+                func.array_remove(
+                    func.array_agg(distinct(cls.updated_by)), None
+                ).label("updated_by"),
+                func.max(cls.payload.op("->>")("created_ago")).label(
+                    "created_ago"
+                ),
+                func.max(cls.payload.op("->>")("updated_at")).label(
+                    "updated_at"
+                ),
             )
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("deleted_at"),
-                text("submitted_at"),
-                text("taskid"),
-                text("username"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
-            )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
+            .filter(cls.project_id == project_id, cls.task_id.in_(task_ids))
+            .group_by(cls.task_id)
+            .all()
         )
+
+    @classmethod
+    def get_completion_owner_submitted_timestamp(
+        cls, project_id: int, task_id: int, completion_id: int
+    ):
+        ensure_project_totals_committed(project_id)
         return (
-            db.session.query(completions_subquery)
-            .with_entities(
-                completions_subquery.c.username,
-                completions_subquery.c.label,
-                completions_subquery.c.chunk,
-                completions_subquery.c.taskid,
-                completions_subquery.c.x,
-                completions_subquery.c.y,
-                completions_subquery.c.width,
-                completions_subquery.c.height,
+            db.session.query(
+                cls.created_username, cls.raw_submitted_at(), cls.review_status
             )
             .filter(
-                completions_subquery.c.deleted_at == None,
-                completions_subquery.c.honeypot == "true",
-                completions_subquery.c.submitted_at != None,
-            )
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("submitted_at"),
-                text("deleted_at"),
-                text("taskid"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
+                cls.project_id == project_id,
+                cls.task_id == task_id,
+                cls.id == completion_id,
             )
-            .all()
+            .first()
         )
 
     @classmethod
-    def get_predictions_for_PVGT_vner(cls, project_id):
+    def get_completion_review_status(
+        cls, project_id: int, task_id: int, completion_id: int
+    ):
         """
-        Get predictions for prediction vs ground truth chart
-        :For Visual NER Project
+        Get completion review status
         """
-        predictions_subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(
-                    is_completions=False, is_visual_ner=True
-                )
-            )
-            .filter(Completions.project_id == project_id)
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("taskid"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
-                text("username"),
+        ensure_project_totals_committed(project_id)
+        return (
+            db.session.query(cls.review_status, cls.raw_submitted_at())
+            .filter(
+                cls.project_id == project_id,
+                cls.task_id == task_id,
+                cls.id == completion_id,
             )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
+            .first()
         )
 
-        return (
-            db.session.query(predictions_subquery)
-            .with_entities(
-                predictions_subquery.c.username,
-                predictions_subquery.c.label,
-                predictions_subquery.c.chunk,
-                predictions_subquery.c.taskid,
-                predictions_subquery.c.x,
-                predictions_subquery.c.y,
-                predictions_subquery.c.width,
-                predictions_subquery.c.height,
-            )
-            .filter(Completions.project_id == project_id)
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("taskid"),
-                text("x"),
-                text("y"),
-                text("width"),
-                text("height"),
+    @classmethod
+    def get_review_states(cls, project_id: int, keys: list):
+        """
+        Review status of many completions with their task's reviewers
+        """
+        if not keys:
+            return {}
+        ensure_project_totals_committed(project_id)
+        rows = (
+            db.session.query(
+                cls.task_pk,
+                cls.task_id,
+                cls.id,
+                cls.review_status,
+                cls.raw_submitted_at(),
+                tasks.Tasks.reviewers,
+            )
+            .join(tasks.Tasks, tasks.Tasks.id == cls.task_pk)
+            .filter(
+                cls.project_id == project_id,
+                tuple_(cls.task_id, cls.id).in_(keys),
             )
             .all()
         )
+        return {(row.task_id, row.id): row for row in rows}
 
     @classmethod
-    def get_completions_for_PVGT(cls, project_id: int, task_ids):
+    def iter_payloads(cls, project_id: int, batch_size: int = 1000):
         """
-        Get completions for prediction vs ground truth chart
+        Completions of the project that are not deleted, batch_size at a
+        time
         """
-        completions_subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(is_completions=True)
-            )
+        ensure_project_totals_committed(project_id)
+        query = (
+            db.session.query(cls.payload)
+            .filter(cls.project_id == project_id, cls.deleted == False)
+            .yield_per(batch_size)
+        )
+        batch = []
+        for (payload,) in query:
+            batch.append(payload)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def get_deleted_since(cls, project_id: int, since):
+        """
+        Soft deleted completions of the tasks modified after since. The
+        deleted_at stamp is application time, not comparable with the
+        database time of since, so the task row's modified_at is used and
+        a completion deleted earlier may be repeated.
+        return: [(task_id, id),]
+        """
+        ensure_project_totals_committed(project_id)
+        return (
+            db.session.query(cls.task_id, cls.id)
+            .join(Completions, Completions.id == cls.task_pk)
             .filter(
+                cls.project_id == project_id,
+                cls.deleted == True,
                 Completions.project_id == project_id,
-                Completions.completion_id.in_(list(task_ids)),
+                Completions.modified_at > since,
             )
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("deleted_at"),
-                text("submitted_at"),
-                text("taskid"),
-                text("username"),
-                text("start"),
-                text("end_index"),
-            )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
+            .order_by(cls.task_id, cls.id)
+            .all()
         )
+
+    @classmethod
+    def get_user_completions(
+        cls, project_id: int, task_id: int, username: str
+    ):
+        ensure_project_totals_committed(project_id)
         return (
-            db.session.query(completions_subquery)
-            .with_entities(
-                completions_subquery.c.username,
-                completions_subquery.c.label,
-                completions_subquery.c.chunk,
-                completions_subquery.c.taskid,
-                completions_subquery.c.start,
-                completions_subquery.c.end_index,
-            )
+            db.session.query(Completions.completions)
+            .join(cls, cls.task_pk == Completions.id)
             .filter(
-                completions_subquery.c.deleted_at == None,
-                completions_subquery.c.honeypot == "true",
-                completions_subquery.c.submitted_at != None,
-            )
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("honeypot"),
-                text("submitted_at"),
-                text("deleted_at"),
-                text("taskid"),
-                text("start"),
-                text("end_index"),
+                cls.project_id == project_id,
+                cls.task_id == task_id,
+                or_(
+                    cls.created_username == username,
+                    cls.updated_by == username,
+                ),
             )
-            .all()
+            .first()
         )
 
+
+class AnnotationSpans(db.Model):
+    """
+    One row per label of a result item of a completion or prediction, kept
+    in step with Completions so charts can read spans with indexed scans.
+    """
+
+    __tablename__ = "annotation_spans"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    task_pk = db.Column(
+        db.ForeignKey("completions.id", ondelete="CASCADE"), nullable=False
+    )
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # Same as Completions.completion_id
+    task_id = db.Column(db.Integer, nullable=False)
+    # "completion" or "prediction"
+    source = db.Column(db.String(10), nullable=False)
+    completion_id = db.Column(db.Integer)
+    username = db.Column(db.String(100))
+    from_name = db.Column(db.String)
+    to_name = db.Column(db.String)
+    type = db.Column(db.String)
+    label = db.Column(db.String)
+    chunk = db.Column(db.String)
+    start = db.Column(db.Float)
+    end_index = db.Column(db.Float)
+    x = db.Column(db.Float)
+    y = db.Column(db.Float)
+    width = db.Column(db.Float)
+    height = db.Column(db.Float)
+    # pageNumber of the result item, for multi-page documents
+    page = db.Column(db.Integer)
+    honeypot = db.Column(db.Boolean, nullable=False, default=False)
+    submitted_at = db.Column(db.DateTime(timezone=True))
+    deleted_at = db.Column(db.DateTime(timezone=True))
+
+    __table_args__ = (
+        db.Index("ix_annotation_spans_task_pk", "task_pk"),
+        db.Index(
+            "ix_annotation_spans_project_source_task",
+            "project_id",
+            "source",
+            "task_id",
+        ),
+        db.Index(
+            "ix_annotation_spans_ground_truth",
+            "project_id",
+            "task_id",
+            "label",
+            postgresql_where=text(
+                "source = 'completion' AND honeypot "
+                "AND submitted_at IS NOT NULL AND deleted_at IS NULL"
+            ),
+        ),
+    )
+
+    COMPLETION = "completion"
+    PREDICTION = "prediction"
+
     @classmethod
-    def get_predictions_for_PVGT(cls, project_id):
+    def common_of(cls, completion: dict, source: str):
         """
-        Get predictions for prediction vs ground truth chart
+        Columns every span of the completion shares
+        """
+        is_completion = source == cls.COMPLETION
+        return {
+            "username": completion.get("created_username"),
+            "honeypot": is_completion and is_honeypot(completion),
+            "submitted_at": parse_timestamp(completion.get("submitted_at"))
+            if is_completion
+            else None,
+            "deleted_at": parse_timestamp(completion.get("deleted_at"))
+            if is_completion
+            else None,
+        }
+
+    @classmethod
+    def spans_of(cls, task_row, completion: dict, source: str):
+        common = {
+            "task_pk": task_row.id,
+            "project_id": task_row.project_id,
+            "task_id": task_row.completion_id,
+            "source": source,
+            "completion_id": completion.get("id"),
+            **cls.common_of(completion, source),
+        }
+        rows = []
+        for result in completion.get("result") or []:
+            value = result.get("value") or {}
+            labels = value.get(result.get("type"))
+            if not isinstance(labels, list):
+                continue
+            chunk = value.get("text")
+            for label in labels:
+                rows.append(
+                    {
+                        **common,
+                        "from_name": result.get("from_name"),
+                        "to_name": result.get("to_name"),
+                        "type": result.get("type"),
+                        "label": label
+                        if isinstance(label, str)
+                        else str(label),
+                        "chunk": chunk[0]
+                        if isinstance(chunk, list) and chunk
+                        else None,
+                        "start": to_number(value.get("start")),
+                        "end_index": to_number(value.get("end")),
+                        "x": to_number(value.get("x_px")),
+                        "y": to_number(value.get("y_px")),
+                        "width": to_number(value.get("width_px")),
+                        "height": to_number(value.get("height_px")),
+                        "page": page_of(result),
+                    }
+                )
+        return rows
+
+    @classmethod
+    def apply(cls, connection, changes: list, page: int = None):
         """
-        predictions_subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(is_completions=False)
+        Replace the spans of changed completions only, and of their page
+        only if page is given
+        """
+        if not changes:
+            return
+        filters = [
+            cls.source == cls.COMPLETION,
+            tuple_(cls.task_pk, cls.completion_id).in_(
+                [change.key for change in changes]
+            ),
+        ]
+        if page is not None:
+            filters.append(cls.page == page)
+        connection.execute(cls.__table__.delete().where(*filters))
+        spans = [
+            span
+            for change in changes
+            if change.new is not None
+            for span in cls.spans_of(change.task, change.new, cls.COMPLETION)
+        ]
+        if spans:
+            connection.execute(cls.__table__.insert(), spans)
+
+    @classmethod
+    def update_fields(cls, connection, changes: list):
+        """
+        Write the shared columns of the spans of completions whose top
+        level fields changed, leaving the spans themselves in place
+        """
+        for change in changes:
+            columns = cls.common_of(change.new, cls.COMPLETION)
+            if columns == cls.common_of(change.old, cls.COMPLETION):
+                continue
+            task_pk, completion_id = change.key
+            connection.execute(
+                update(cls.__table__)
+                .where(
+                    cls.source == cls.COMPLETION,
+                    cls.task_pk == task_pk,
+                    cls.completion_id == completion_id,
+                )
+                .values(columns)
             )
-            .filter(Completions.project_id == project_id)
-            .group_by(
-                text("label"),
-                text("chunk"),
-                text("taskid"),
-                text("start"),
-                text("end_index"),
-                text("username"),
+
+    @classmethod
+    def sync_predictions(cls, connection, task_rows: list):
+        """
+        Replace the prediction spans of the given tasks
+        """
+        connection.execute(
+            cls.__table__.delete().where(
+                cls.source == cls.PREDICTION,
+                cls.task_pk.in_([row.id for row in task_rows]),
             )
-            .order_by(text("label"), text("taskid"))
-            .subquery()
         )
+        spans = [
+            span
+            for row in task_rows
+            for prediction in row.predictions or []
+            for span in cls.spans_of(row, prediction, cls.PREDICTION)
+        ]
+        if spans:
+            connection.execute(cls.__table__.insert(), spans)
+
+    @classmethod
+    def ground_truth_filters(cls, project_id: int):
+        ensure_project_totals_committed(project_id)
+        return [
+            cls.project_id == project_id,
+            cls.source == cls.COMPLETION,
+            cls.honeypot == True,
+            cls.submitted_at != None,
+            cls.deleted_at == None,
+        ]
+
+    @classmethod
+    def prediction_filters(cls, project_id: int):
+        ensure_project_totals_committed(project_id)
+        return [cls.project_id == project_id, cls.source == cls.PREDICTION]
+
+    @classmethod
+    def span_fields(cls, is_visual_ner: bool = False):
+        """
+        Span columns as the charts expect them: positions are text, like
+        they used to be when read straight from the JSON.
+        """
+        positions = (
+            [cls.x, cls.y, cls.width, cls.height]
+            if is_visual_ner
+            else [cls.start, cls.end_index]
+        )
+        return [
+            cls.label,
+            cls.chunk,
+            cls.task_id.label("taskid"),
+            *[
+                cast(column, db.String).label(column.key)
+                for column in positions
+            ],
+        ]
 
+    @classmethod
+    def query_spans(cls, fields: list, filters: list, group_by: list = []):
+        """
+        Distinct spans: same fields, group by all of them
+        """
         return (
-            db.session.query(predictions_subquery)
-            .with_entities(
-                predictions_subquery.c.username,
-                predictions_subquery.c.label,
-                predictions_subquery.c.chunk,
-                predictions_subquery.c.taskid,
-                predictions_subquery.c.start,
-                predictions_subquery.c.end_index,
-            )
-            .filter(Completions.project_id == project_id)
-            .group_by(
-                text("username"),
-                text("label"),
-                text("chunk"),
-                text("taskid"),
-                text("start"),
-                text("end_index"),
-            )
+            db.session.query(*fields)
+            .filter(*filters)
+            .group_by(*fields, *group_by)
             .all()
         )
 
+
+class CompletionTombstones(db.Model):
+    """
+    Tasks whose Completions row was deleted, for incremental exports
+    """
+
+    __tablename__ = "completion_tombstones"
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # Same as Completions.completion_id
+    task_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(
+        db.DateTime(timezone=True), server_default=func.now(), nullable=False
+    )
+
+    __table_args__ = (
+        db.Index(
+            "ix_completion_tombstones_project_deleted_at",
+            "project_id",
+            "deleted_at",
+        ),
+    )
+
     @classmethod
-    def get_completion_for_CEBA(cls, project_id, is_visual_ner: bool = False):
+    def trigger_ddl(cls):
         """
-        Get completions for chunk extracted by annotator chart
-        For: chunk_extracted_by_label, chunk_extracted_by_annotator chart
+        Statement level trigger recording the deleted completions rows of
+        projects that are not being deleted themselves, cascades included
         """
+        projects = user_projects.UserProjects.__tablename__
+        table = Completions.__tablename__
+        return [
+            f"""
+            CREATE OR REPLACE FUNCTION {table}_add_tombstones()
+            RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO {cls.__tablename__} (project_id, task_id)
+                SELECT d.project_id, d.completion_id
+                FROM deleted_rows AS d
+                JOIN {projects} AS p ON p.project_id = d.project_id;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            f"DROP TRIGGER IF EXISTS {table}_tombstones ON {table}",
+            f"""
+            CREATE TRIGGER {table}_tombstones
+            AFTER DELETE ON {table}
+            REFERENCING OLD TABLE AS deleted_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {table}_add_tombstones()
+            """,
+        ]
 
-        group_by = [
-            text("label"),
-            text("username"),
-            text("chunk"),
-            text("honeypot"),
-            text("submitted_at"),
-            text("deleted_at"),
+    @classmethod
+    def get_task_ids_since(cls, project_id: int, since):
+        return [
+            task_id
+            for task_id, in db.session.query(cls.task_id)
+            .filter(cls.project_id == project_id, cls.deleted_at > since)
+            .distinct()
+            .order_by(cls.task_id)
         ]
 
-        group_by.extend(
-            [text("x"), text("y"), text("width"), text("height")]
-            if is_visual_ner
-            else [text("start"), text("end_index")]
+
+class ProjectRevisions(db.Model):
+    """
+    Per project counter of content changes, so exports can be cached and
+    revalidated against it. Database triggers bump it on every write to
+    completions, tasks and tagged tasks, cascades included.
+    """
+
+    __tablename__ = "project_revisions"
+
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def trigger_ddl(cls):
+        """
+        Statement level triggers bumping the projects of the changed rows,
+        read from the transition table changed_rows. Projects being
+        deleted are skipped.
+        """
+        projects = user_projects.UserProjects.__tablename__
+        task_table = tasks.Tasks.__tablename__
+        sources = {
+            # table: rows of the table -> project ids
+            Completions.__tablename__: "SELECT project_id FROM changed_rows",
+            task_table: "SELECT project_id FROM changed_rows",
+            tasks.TaggedTasks.__tablename__: (
+                f"SELECT t.project_id FROM changed_rows AS c"
+                f" JOIN {task_table} AS t ON t.id = c.task_pk"
+            ),
+        }
+        statements = []
+        for table, project_ids in sources.items():
+            function = f"{table}_bump_project_revisions"
+            statements.append(
+                f"""
+                CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO {cls.__tablename__} AS r
+                        (project_id, revision)
+                    SELECT DISTINCT p.project_id, 1
+                    FROM {projects} AS p
+                    WHERE p.project_id IN ({project_ids})
+                    ORDER BY p.project_id
+                    ON CONFLICT (project_id)
+                    DO UPDATE SET revision = r.revision + 1;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+                """
+            )
+            for operation, rows in (
+                ("INSERT", "NEW"),
+                ("UPDATE", "NEW"),
+                ("DELETE", "OLD"),
+            ):
+                trigger = f"{table}_revision_{operation.lower()}"
+                statements += [
+                    f"DROP TRIGGER IF EXISTS {trigger} ON {table}",
+                    f"""
+                    CREATE TRIGGER {trigger}
+                    AFTER {operation} ON {table}
+                    REFERENCING {rows} TABLE AS changed_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+                    """,
+                ]
+        return statements
+
+    @classmethod
+    def read(cls, project_id: int):
+        """
+        return: revision of the project, None until the triggers bumped it
+        once (e.g. they are not installed yet), in which case nothing may
+        be cached against it
+        """
+        return (
+            db.session.query(cls.revision)
+            .filter(cls.project_id == project_id)
+            .scalar()
+        )
+
+
+class CompletionCounters(db.Model):
+    """
+    Completion counts per project (tag_id 0) and per tag of the project,
+    updated with every write so counts are read in O(1)
+    """
+
+    __tablename__ = "completion_counters"
+
+    PROJECT = 0
+
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    tag_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Tasks with at least one completion
+    tasks_with_completions = db.Column(db.Integer, nullable=False, default=0)
+    # Ground truth completions, submitted and reviewed
+    ground_truth_submitted = db.Column(db.Integer, nullable=False, default=0)
+    ground_truth_reviewed = db.Column(db.Integer, nullable=False, default=0)
+
+    COUNTS = (
+        "tasks_with_completions",
+        "ground_truth_submitted",
+        "ground_truth_reviewed",
+    )
+
+    @staticmethod
+    def counts_of(task_row, completion: dict):
+        """
+        (submitted, reviewed) ground truth counts of one completion
+        """
+        if completion is None:
+            return 0, 0
+        item = CompletionItems.item_of(task_row, completion)
+        return (
+            int(item["honeypot"] and item["submitted"]),
+            int(item["honeypot"] and item["review_status"] is not None),
         )
 
-        subquery = (
-            Completions.query.with_entities(
-                *cls.get_completions_result_fields(
-                    is_visual_ner=is_visual_ner
-                )[:-1]
+    @classmethod
+    def sync(cls, connection, changes: list, task_counts: dict = {}):
+        """
+        Apply the counts of changed completions
+        :param task_counts: {task pk: (task row, 1 or -1)} for tasks that
+            got their first completion or lost their last one
+        """
+        task_deltas = {
+            task_pk: (task_row, [count, 0, 0])
+            for task_pk, (task_row, count) in task_counts.items()
+        }
+        for change in changes:
+            old = cls.counts_of(change.task, change.old)
+            new = cls.counts_of(change.task, change.new)
+            if old == new:
+                continue
+            _, delta = task_deltas.setdefault(
+                change.task.id, (change.task, [0, 0, 0])
+            )
+            for index, (n, o) in enumerate(zip(new, old), start=1):
+                delta[index] += n - o
+        task_deltas = {
+            task_pk: (task_row, delta)
+            for task_pk, (task_row, delta) in task_deltas.items()
+            if any(delta)
+        }
+        if not task_deltas:
+            return
+
+        task_tags = {}
+        for task_pk, tag_id in connection.execute(
+            db.select(
+                tasks.TaggedTasks.task_pk, tasks.TaggedTasks.tag_id
+            ).where(tasks.TaggedTasks.task_pk.in_(list(task_deltas)))
+        ):
+            task_tags.setdefault(task_pk, []).append(tag_id)
+        deltas = {}
+        for task_pk, (task_row, delta) in task_deltas.items():
+            for tag_id in [cls.PROJECT, *task_tags.get(task_pk, [])]:
+                total = deltas.setdefault(
+                    (task_row.project_id, tag_id), [0, 0, 0]
+                )
+                for index, value in enumerate(delta):
+                    total[index] += value
+        cls.apply(connection, deltas)
+
+    @classmethod
+    def apply(cls, connection, deltas: dict):
+        """
+        :param deltas: {(project_id, tag_id): [tasks, submitted, reviewed]}
+        """
+        statement = insert(cls.__table__).values(
+            [
+                {
+                    "project_id": project_id,
+                    "tag_id": tag_id,
+                    **dict(zip(cls.COUNTS, delta)),
+                }
+                for (project_id, tag_id), delta in sorted(deltas.items())
+            ]
+        )
+        connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.project_id, cls.tag_id],
+                set_={
+                    name: cls.__table__.c[name] + statement.excluded[name]
+                    for name in cls.COUNTS
+                },
             )
-            .filter(Completions.project_id == project_id)
-            .group_by(*group_by)
-            .order_by(text("label"))
-            .subquery()
         )
 
+    @classmethod
+    def trigger_ddl(cls):
+        """
+        Statement level triggers moving the counts of tasks tagged or
+        untagged, read from their completion_items, into or out of the tag
+        counters. Projects not built yet are skipped (ensure_project_totals
+        counts their tags), and so are tasks being deleted, whose counts
+        forget_deleted_tasks removes.
+        """
+        items = CompletionItems.__tablename__
+        task_table = tasks.Tasks.__tablename__
+        table = tasks.TaggedTasks.__tablename__
+        statements = []
+        for operation, rows, sign in (
+            ("INSERT", "NEW", 1),
+            ("DELETE", "OLD", -1),
+        ):
+            function = f"{table}_{operation.lower()}_completion_counters"
+            trigger = f"{table}_counters_{operation.lower()}"
+            statements += [
+                f"""
+                CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO {cls.__tablename__} AS c (
+                        project_id, tag_id, tasks_with_completions,
+                        ground_truth_submitted, ground_truth_reviewed
+                    )
+                    SELECT t.project_id, r.tag_id,
+                        {sign} * count(DISTINCT i.task_pk),
+                        {sign} * count(*) FILTER (
+                            WHERE i.honeypot AND i.submitted
+                        ),
+                        {sign} * count(*) FILTER (
+                            WHERE i.honeypot AND i.review_status IS NOT NULL
+                        )
+                    FROM changed_rows AS r
+                    JOIN {task_table} AS t ON t.id = r.task_pk
+                    JOIN {items} AS i ON i.task_pk = r.task_pk
+                    WHERE EXISTS (
+                        SELECT FROM {cls.__tablename__} AS p
+                        WHERE p.project_id = t.project_id
+                        AND p.tag_id = {cls.PROJECT}
+                    )
+                    GROUP BY t.project_id, r.tag_id
+                    ORDER BY t.project_id, r.tag_id
+                    ON CONFLICT (project_id, tag_id) DO UPDATE SET
+                        tasks_with_completions = c.tasks_with_completions
+                            + excluded.tasks_with_completions,
+                        ground_truth_submitted = c.ground_truth_submitted
+                            + excluded.ground_truth_submitted,
+                        ground_truth_reviewed = c.ground_truth_reviewed
+                            + excluded.ground_truth_reviewed;
+                    RETURN NULL;
+                END
+                $$ LANGUAGE plpgsql
+                """,
+                f"DROP TRIGGER IF EXISTS {trigger} ON {table}",
+                f"""
+                CREATE TRIGGER {trigger}
+                AFTER {operation} ON {table}
+                REFERENCING {rows} TABLE AS changed_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION {function}()
+                """,
+            ]
+        return statements
+
+    @classmethod
+    def exists(cls, connection, project_id: int):
         return (
-            db.session.query(subquery)
-            .with_entities(
-                subquery.c.username,
-                subquery.c.chunk,
-                subquery.c.label,
+            connection.execute(
+                db.select(cls.project_id).where(
+                    cls.project_id == project_id, cls.tag_id == cls.PROJECT
+                )
+            ).first()
+            is not None
+        )
+
+    @classmethod
+    def read(cls, project_id: int, tag_id: int = PROJECT):
+        ensure_project_totals_committed(project_id)
+        counters = cls.query.filter_by(
+            project_id=project_id, tag_id=tag_id
+        ).first()
+        return counters or cls(
+            project_id=project_id,
+            tag_id=tag_id,
+            tasks_with_completions=0,
+            ground_truth_submitted=0,
+            ground_truth_reviewed=0,
+        )
+
+    @classmethod
+    def get_al_completions_count(
+        cls, project_id: int, tags: list, completions_filter: str
+    ):
+        column = (
+            cls.ground_truth_reviewed
+            if completions_filter == "reviewed"
+            else cls.ground_truth_submitted
+        )
+        if not tags:
+            return getattr(cls.read(project_id), column.key)
+        ensure_project_totals_committed(project_id)
+        tag_ids = db.session.query(TAGS.Tags.tag_id).filter(
+            TAGS.Tags.project_id == project_id,
+            TAGS.Tags.tag_name.in_(tags),
+        )
+        return (
+            db.session.query(func.coalesce(func.sum(column), 0))
+            .filter(cls.project_id == project_id, cls.tag_id.in_(tag_ids))
+            .scalar()
+        )
+
+    @classmethod
+    def rebuild(cls, connection, project_id: int):
+        """
+        Recount the counters of the project from Completions.completions.
+        Ground truth is counted from the rows the has_honeypot index finds.
+        The rows are deleted first: that waits for writers that already
+        applied deltas, so the counts below see their writes.
+        """
+        connection.execute(
+            cls.__table__.delete().where(cls.project_id == project_id)
+        )
+        with_ids = func.jsonb_path_exists(
+            Completions.completions,
+            literal_column("'$[*] ? (@.id != null)'::jsonpath"),
+        )
+        unnested, value, _ = Completions.unnested()
+        ground_truth = [
+            value.op("->>")("id") != None,
+            value.op("->>")("honeypot") == "true",
+        ]
+        queries = (
+            (
+                slice(0, 1),
+                db.select(func.count())
+                .select_from(Completions)
+                .where(Completions.project_id == project_id, with_ids),
+            ),
+            (
+                slice(1, 3),
+                unnested.with_entities(
+                    func.count().filter(
+                        *ground_truth,
+                        func.coalesce(value.op("->>")("submitted_at"), "")
+                        != "",
+                    ),
+                    func.count().filter(
+                        *ground_truth,
+                        func.coalesce(
+                            value.op("->")("review_status"),
+                            cast("null", JSONB),
+                        )
+                        != cast("null", JSONB),
+                    ),
+                )
+                .filter(
+                    Completions.project_id == project_id,
+                    Completions.has_honeypot == True,
+                )
+                .statement,
+            ),
+        )
+        tagged = tasks.TaggedTasks
+        deltas = {(project_id, cls.PROJECT): [0, 0, 0]}
+        for columns, query in queries:
+            deltas[(project_id, cls.PROJECT)][columns] = connection.execute(
+                query
+            ).one()
+            for tag_id, *counts in connection.execute(
+                query.with_only_columns(tagged.tag_id, *query.selected_columns)
+                .join(tagged, tagged.task_pk == Completions.id)
+                .group_by(tagged.tag_id)
+            ):
+                deltas.setdefault((project_id, tag_id), [0, 0, 0])[
+                    columns
+                ] = counts
+        cls.apply(connection, deltas)
+
+
+class OutputSchemaTuples(db.Model):
+    """
+    Distinct (from_name, to_name, type, value shape) of the results of
+    completions not deleted, with the number of results referencing them.
+    The output schema is derived from these rows.
+    """
+
+    __tablename__ = "output_schema_tuples"
+
+    project_id = db.Column(
+        db.ForeignKey("user_projects.project_id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    from_name = db.Column(db.String, primary_key=True)
+    to_name = db.Column(db.String, primary_key=True)
+    type = db.Column(db.String, primary_key=True)
+    # Sorted "key:type" pairs of the result value
+    value_shape = db.Column(db.String, primary_key=True)
+    # First value seen with this shape
+    value = db.Column(JSONB)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+    # Session info key of the projects whose tuples were added or removed
+    CHANGED = "output_schema_changed"
+
+    @staticmethod
+    def shape_of(value):
+        if not isinstance(value, dict):
+            return type(value).__name__
+        return ",".join(
+            f"{key}:{type(item).__name__}"
+            for key, item in sorted(value.items())
+        )
+
+    @classmethod
+    def tuples_of(cls, completions: list):
+        """
+        Results without from_name or to_name (relation, pairwise) have no
+        tuple.
+        return: {(from_name, to_name, type, value_shape): [count, value]}
+        """
+        tuples = {}
+        for completion in completions:
+            if completion.get("deleted_at"):
+                continue
+            for result in completion.get("result") or []:
+                if any(
+                    result.get(key) is None
+                    for key in ("from_name", "to_name", "type")
+                ):
+                    continue
+                key = (
+                    result.get("from_name"),
+                    result.get("to_name"),
+                    result.get("type"),
+                    cls.shape_of(result.get("value")),
+                )
+                tuples.setdefault(key, [0, result.get("value")])[0] += 1
+        return tuples
+
+    @classmethod
+    def sync(cls, connection, changes: list):
+        """
+        Apply the tuples of changed completions
+        """
+        deltas = {}
+        for change in changes:
+            for completion, sign in ((change.old, -1), (change.new, 1)):
+                if completion is None:
+                    continue
+                for key, (count, value) in cls.tuples_of([completion]).items():
+                    delta = deltas.setdefault(
+                        (change.task.project_id, *key), [0, value]
+                    )
+                    delta[0] += sign * count
+        deltas = {key: delta for key, delta in deltas.items() if delta[0]}
+        if deltas:
+            cls.apply(connection, deltas)
+
+    @classmethod
+    def apply(cls, connection, deltas: dict):
+        """
+        :param deltas: {(project_id, from_name, to_name, type, value_shape):
+            [count, value]}
+        Projects whose tuple set changed are recorded in the session info
+        under CHANGED.
+        """
+        statement = insert(cls.__table__).values(
+            [
+                {
+                    "project_id": project_id,
+                    "from_name": from_name,
+                    "to_name": to_name,
+                    "type": config_type,
+                    "value_shape": value_shape,
+                    "value": value,
+                    "ref_count": count,
+                }
+                for (
+                    (project_id, from_name, to_name, config_type, value_shape),
+                    (count, value),
+                ) in sorted(deltas.items(), key=lambda item: item[0])
+            ]
+        )
+        ref_count = cls.__table__.c.ref_count
+        updated = connection.execute(
+            statement.on_conflict_do_update(
+                index_elements=[
+                    cls.project_id,
+                    cls.from_name,
+                    cls.to_name,
+                    cls.type,
+                    cls.value_shape,
+                ],
+                set_={"ref_count": ref_count + statement.excluded.ref_count},
+            ).returning(
+                cls.project_id,
+                ref_count,
+                # xmax is 0 for inserted rows
+                literal_column("xmax = 0", db.Boolean).label("inserted"),
             )
-            .filter(
-                subquery.c.deleted_at == None,
-                subquery.c.honeypot == "true",
-                subquery.c.submitted_at != None,
+        ).all()
+        changed = {
+            row.project_id
+            for row in updated
+            if row.inserted or row.ref_count <= 0
+        }
+        if changed:
+            connection.execute(
+                cls.__table__.delete().where(
+                    cls.project_id.in_(changed), ref_count <= 0
+                )
             )
-            .group_by(*group_by)
+            db.session.info.setdefault(cls.CHANGED, set()).update(changed)
+
+    @classmethod
+    def read(cls, project_id: int):
+        ensure_project_totals_committed(project_id)
+        return (
+            db.session.query(cls.from_name, cls.to_name, cls.type, cls.value)
+            .filter(cls.project_id == project_id, cls.ref_count > 0)
             .all()
         )
 
+    @classmethod
+    def rebuild(cls, connection, project_id: int):
+        """
+        Recompute the tuples of the project from Completions.completions,
+        deleting them first like CompletionCounters.rebuild
+        """
+        connection.execute(
+            cls.__table__.delete().where(cls.project_id == project_id)
+        )
+        deltas = {}
+        for row in connection.execute(
+            Completions.scan_completion_result_detail(project_id).statement
+        ):
+            key = (
+                project_id,
+                row.from_name,
+                row.to_name,
+                row.type,
+                cls.shape_of(row.value),
+            )
+            deltas.setdefault(key, [0, row.value])[0] += 1
+        if deltas:
+            cls.apply(connection, deltas)
+
+    @classmethod
+    def pop_changed(cls, project_id: int):
+        """
+        Whether the tuple set of the project changed in this session
+        """
+        changed = db.session.info.get(cls.CHANGED, set())
+        if project_id in changed:
+            changed.discard(project_id)
+            return True
+        return False
+
+
+class TaskRow:
+    """
+    Task row for sync_derived_tables outside of a flush
+    """
+
+    def __init__(
+        self, id, project_id, completion_id, completions=(), predictions=()
+    ):
+        self.id = id
+        self.project_id = project_id
+        self.completion_id = completion_id
+        self.completions = completions
+        self.predictions = predictions
+
+
+class ElementChange:
+    """
+    One completion of a task before and after a write, None where it does
+    not exist
+    """
+
+    def __init__(self, task, old, new):
+        self.task = task
+        self.old = old
+        self.new = new
+
+    @property
+    def key(self):
+        return self.task.id, int((self.new or self.old)["id"])
+
+
+def completions_by_id(completions):
+    return {
+        int(completion["id"]): completion
+        for completion in completions or []
+        if completion.get("id") is not None
+    }
+
+
+def element_changes(task_row, old_completions, new_completions):
+    """
+    Completions of the task that differ between the two arrays, by id
+    """
+    old = completions_by_id(old_completions)
+    new = completions_by_id(new_completions)
+    return [
+        ElementChange(task_row, old.get(id), new.get(id))
+        for id in sorted(old.keys() | new.keys())
+        if old.get(id) != new.get(id)
+    ]
+
+
+def ensure_project_totals(connection, project_ids: set):
+    """
+    Build the tables derived from Completions (items and spans, then the
+    counters and output schema tuples) of projects that have no PROJECT
+    counters row yet, e.g. projects created before the tables existed.
+    This runs under a per project advisory lock so that concurrent
+    writers build a project once and apply their deltas after it is
+    built.
+    return: project ids built now, which already include this write
+    """
+    built = set()
+    for project_id in sorted(project_ids):
+        if CompletionCounters.exists(connection, project_id):
+            continue
+        lock_project_totals(connection, project_id)
+        if CompletionCounters.exists(connection, project_id):
+            continue
+        task_pks = [
+            task_pk
+            for task_pk, in connection.execute(
+                db.select(Completions.id)
+                .where(Completions.project_id == project_id)
+                .order_by(Completions.id)
+            )
+        ]
+        for start in range(0, len(task_pks), REBUILD_BATCH_SIZE):
+            rebuild_task_items(
+                connection,
+                connection.execute(
+                    db.select(*Completions.sync_columns()).where(
+                        Completions.id.in_(
+                            task_pks[start : start + REBUILD_BATCH_SIZE]
+                        )
+                    )
+                ).all(),
+            )
+        CompletionCounters.rebuild(connection, project_id)
+        OutputSchemaTuples.rebuild(connection, project_id)
+        built.add(project_id)
+    return built
+
+
+def rebuild_task_items(connection, task_rows: list):
+    """
+    Recompute the completion items and annotation spans of the given
+    Completions rows
+    """
+    task_pks = [row.id for row in task_rows]
+    for table in (CompletionItems, AnnotationSpans):
+        connection.execute(
+            table.__table__.delete().where(table.task_pk.in_(task_pks))
+        )
+    changes = [
+        change
+        for row in task_rows
+        for change in element_changes(row, [], row.completions)
+    ]
+    CompletionItems.apply(connection, changes)
+    AnnotationSpans.apply(connection, changes)
+    AnnotationSpans.sync_predictions(connection, task_rows)
+
+
+def lock_project_totals(connection, project_id: int):
+    """
+    Advisory lock held until the end of the transaction by whoever builds
+    the counters and output schema tuples of the project
+    """
+    connection.execute(
+        db.select(
+            func.pg_advisory_xact_lock(
+                func.hashtext(CompletionCounters.__tablename__), project_id
+            )
+        )
+    )
+
+
+def ensure_project_totals_committed(project_id: int):
+    """
+    ensure_project_totals for readers, in a transaction of its own so that
+    whatever the caller has pending is not committed with it. Nothing is
+    done when the session already sees the project built, which is the
+    case whenever its own transaction holds the lock.
+    """
+    if CompletionCounters.exists(db.session.connection(), project_id):
+        return
+    with db.engine.begin() as connection:
+        ensure_project_totals(connection, {project_id})
+
+
+def sync_completion_changes(connection, changes: list, task_counts={}):
+    """
+    Write changed completions to the tables derived from them
+    """
+    built = ensure_project_totals(
+        connection, {change.task.project_id for change in changes}
+    )
+    CompletionCounters.sync(
+        connection,
+        [change for change in changes if change.task.project_id not in built],
+        {
+            task_pk: (task_row, count)
+            for task_pk, (task_row, count) in task_counts.items()
+            if task_row.project_id not in built
+        },
+    )
+    OutputSchemaTuples.sync(
+        connection,
+        [change for change in changes if change.task.project_id not in built],
+    )
+    CompletionItems.apply(connection, changes)
+    AnnotationSpans.apply(connection, changes)
+
+
+def sync_completion_fields(connection, task_row, old, new, page=None):
+    """
+    Derived tables of one completion whose top level fields changed. old
+    and new carry a result only where it matters: the whole result when
+    deleted_at changed, or the items of page when only that page's items
+    were replaced. The completion_items payload is written by the
+    statement that changed the completion.
+    """
+    changes = [ElementChange(task_row, old, new)]
+    if not ensure_project_totals(connection, {task_row.project_id}):
+        CompletionCounters.sync(connection, changes)
+        OutputSchemaTuples.sync(connection, changes)
+    CompletionItems.update_fields(connection, changes)
+    AnnotationSpans.update_fields(connection, changes)
+    if page is not None:
+        AnnotationSpans.apply(connection, changes, page)
+
+
+def forget_deleted_tasks(connection, task_rows):
+    """
+    Counters and output schema tuples for Completions rows about to be
+    deleted; the other derived tables follow by cascade and triggers
+    """
+    task_rows = list(task_rows)
+    if not task_rows:
+        return
+    # Built before the rows go, so the deltas below still apply
+    ensure_project_totals(connection, {row.project_id for row in task_rows})
+    old_completions = CompletionItems.get_payloads(
+        connection, [row.id for row in task_rows]
+    )
+    changes, task_counts = [], {}
+    for row in task_rows:
+        old = old_completions[row.id]
+        changes.extend(element_changes(row, old, []))
+        if old:
+            task_counts[row.id] = (row, -1)
+    CompletionCounters.sync(connection, changes, task_counts)
+    OutputSchemaTuples.sync(connection, changes)
+
+
+def sync_derived_tables(
+    connection, task_rows, old_completions=None, predictions=True
+):
+    """
+    Bring the tables derived from Completions in line with the given task
+    rows, on the connection (and transaction) that wrote them. Only the
+    completions that differ from old_completions ({task pk: [completion,]},
+    read from completion_items if not given) are written.
+    :param predictions: whether the predictions may have changed too
+    """
+    task_rows = list(task_rows)
+    if not task_rows:
+        return
+    if old_completions is None:
+        # Projects not built yet are built first, with this write, so the
+        # old completions are not read from missing items
+        ensure_project_totals(
+            connection, {row.project_id for row in task_rows}
+        )
+        old_completions = CompletionItems.get_payloads(
+            connection, [row.id for row in task_rows]
+        )
+    changes, task_counts = [], {}
+    for row in task_rows:
+        old = completions_by_id(old_completions.get(row.id))
+        new = completions_by_id(row.completions)
+        changes.extend(element_changes(row, old.values(), new.values()))
+        if bool(new) != bool(old):
+            task_counts[row.id] = (row, 1 if new else -1)
+    sync_completion_changes(connection, changes, task_counts)
+    if predictions:
+        AnnotationSpans.sync_predictions(connection, task_rows)
+
+
+def rebuild_derived_tables(
+    project_id: int, batch_size: int = REBUILD_BATCH_SIZE
+):
+    """
+    Recompute every table derived from Completions for the project: items
+    and spans one locked batch of tasks at a time, then the counters and
+    output schema tuples. Backfills projects created before a table
+    existed and repairs drift; safe to run while the project is in use.
+    """
+    task_pks = [
+        task_pk
+        for task_pk, in db.session.query(Completions.id)
+        .filter(Completions.project_id == project_id)
+        .order_by(Completions.id)
+    ]
+    for start in range(0, len(task_pks), batch_size):
+        connection = db.session.connection()
+        batch = (
+            db.session.query(*Completions.sync_columns())
+            .filter(Completions.id.in_(task_pks[start : start + batch_size]))
+            .with_for_update()
+            .all()
+        )
+        rebuild_task_items(connection, batch)
+        db.session.commit()
+
+    connection = db.session.connection()
+    lock_project_totals(connection, project_id)
+    CompletionCounters.rebuild(connection, project_id)
+    OutputSchemaTuples.rebuild(connection, project_id)
+    db.session.commit()
+
+
+@event.listens_for(Completions, "after_insert")
+def _sync_inserted_row(mapper, connection, target):
+    sync_derived_tables(connection, [target], {target.id: []})
+
+
+@event.listens_for(Completions, "after_update")
+def _sync_updated_row(mapper, connection, target):
+    attrs = inspect(target).attrs
+    completions = attrs.completions.history
+    predictions = attrs.predictions.history.has_changes()
+    if not completions.has_changes() and not predictions:
+        return
+    old_completions = None
+    if not completions.has_changes():
+        old_completions = {target.id: target.completions}
+    elif completions.deleted:
+        # Value loaded before the write, no need to read it back
+        old_completions = {target.id: completions.deleted[0]}
+    sync_derived_tables(connection, [target], old_completions, predictions)
+
+
+@event.listens_for(Completions, "before_delete")
+def _forget_deleted_task(mapper, connection, target):
+    forget_deleted_tasks(connection, [target])
+
+
+def completion_trigger_ddl():
+    """
+    Statements (re)creating the triggers behind ProjectRevisions,
+    CompletionTombstones and the tag counters. They can be run again on
+    a database that has them, which the install-completion-triggers
+    command does for databases created before the triggers existed.
+    """
+    return [
+        *ProjectRevisions.trigger_ddl(),
+        *CompletionTombstones.trigger_ddl(),
+        *CompletionCounters.trigger_ddl(),
+    ]
+
+
+for statement in completion_trigger_ddl():
+    event.listen(
+        db.metadata,
+        "after_create",
+        DDL(statement).execute_if(dialect="postgresql"),
+    )
+
 
 # Used in ALAB <= v.2.5.0
 class CompletionsResultView(db.Model):
@@ -973,6 +2928,56 @@ class CompletionsMeta(db.Model):
     def read(cls, project_id: int):
         return cls.query.filter_by(project_id=project_id).first()
 
+    @classmethod
+    def increment_used_labels_info(cls, project_id: int, deltas: list):
+        """
+        Add label count deltas to used_labels_info in one statement. The
+        row lock of the UPDATE serializes concurrent writers, so no
+        increment is lost. Labels whose count drops below 1 are removed.
+        Projects created before v2.6.0 (no created_version) are skipped.
+        :param deltas: [{"from_name": .., "label": .., "count": ..},]
+        """
+        if not deltas:
+            return
+        statement = text(
+            f"""
+            UPDATE {cls.__tablename__} SET used_labels_info = (
+                SELECT coalesce(jsonb_object_agg(from_name, labels), '{{}}')
+                FROM (
+                    SELECT from_name, jsonb_object_agg(label, total) AS labels
+                    FROM (
+                        SELECT from_name, label, sum(count) AS total
+                        FROM (
+                            SELECT names.key AS from_name,
+                                   labels.key AS label,
+                                   labels.value::int AS count
+                            FROM jsonb_each(
+                                coalesce(used_labels_info, '{{}}')
+                            ) AS names,
+                            jsonb_each_text(names.value) AS labels
+                            UNION ALL
+                            SELECT from_name, label, count
+                            FROM jsonb_to_recordset(CAST(:deltas AS jsonb))
+                            AS d(from_name text, label text, count int)
+                        ) AS merged
+                        GROUP BY from_name, label
+                        HAVING sum(count) > 0
+                    ) AS totals
+                    GROUP BY from_name
+                ) AS grouped
+            )
+            WHERE project_id = :project_id AND EXISTS (
+                SELECT 1 FROM {user_projects.UserProjects.__tablename__}
+                WHERE project_id = :project_id
+                AND created_version IS NOT NULL
+            )
+            """
+        )
+        db.session.execute(
+            statement, {"project_id": project_id, "deltas": json.dumps(deltas)}
+        )
+        db.session.commit()
+
     @classmethod
     def delete(cls, project_id: int):
         db.session.query(cls).filter(cls.project_id == project_id).delete()
@@ -0,0 +1,132 @@
+"""
+Tests for completion writes against the database: projects and tasks are
+created through the UI, completions are written with the models
+"""
+import pytest
+from tests.utils.helpers import *
+from ai_project.db import app, db
+from ai_project.helpers.completions import project_metadata, task_acls
+from ai_project.models.completions import (
+    CompletionCounters,
+    Completions,
+    CompletionsMeta,
+    VersionConflict,
+)
+
+
+@pytest.fixture
+def project(browser, request):
+    project_name = unique_project_name(request.node.name)
+    create_project(browser, project_name)
+    create_task(browser, project_name)
+    with app.app_context():
+        yield project_metadata.get(project_name)
+        db.session.rollback()
+    delete_project(browser, project_name)
+
+
+def span(label, item_id="a"):
+    return {
+        "id": item_id,
+        "from_name": "label",
+        "to_name": "text",
+        "type": "labels",
+        "value": {"start": 0, "end": 4, "labels": [label]},
+    }
+
+
+def add_completion(project, completion, task_id=1):
+    """
+    return: (task pk, completion id)
+    """
+    task_pk = task_acls.get(project.project_id, task_id, fresh=True).id
+    completion_ids = Completions.add_completions(
+        project.project_id, "admin", {task_pk: (task_id, [completion])}
+    )
+    return task_pk, completion_ids[task_pk][0]
+
+
+def used_labels(project_id):
+    db.session.expire_all()
+    meta = CompletionsMeta.read(project_id)
+    return (meta.used_labels_info or {}).get("label", {})
+
+
+def test_increment_used_labels_info(project):
+    project_id = project.project_id
+    delta = {"from_name": "label", "label": "TEST_LABEL"}
+    CompletionsMeta.increment_used_labels_info(
+        project_id, [{**delta, "count": 2}]
+    )
+    assert used_labels(project_id)["TEST_LABEL"] == 2
+
+    CompletionsMeta.increment_used_labels_info(
+        project_id, [{**delta, "count": -1}]
+    )
+    assert used_labels(project_id)["TEST_LABEL"] == 1
+
+    # Labels that are not used any more are dropped
+    CompletionsMeta.increment_used_labels_info(
+        project_id, [{**delta, "count": -1}]
+    )
+    assert "TEST_LABEL" not in used_labels(project_id)
+
+
+def test_stale_version_conflicts(project):
+    task_pk, completion_id = add_completion(project, {"result": [span("PER")]})
+    fields = {"updated_by": "admin"}
+
+    _, new_items, version = Completions.apply_result_delta(
+        task_pk, completion_id, [span("ORG", "b")], [], [], fields, version=1
+    )
+    assert (new_items, version) == ([span("ORG", "b")], 2)
+
+    # A writer still at version 1 changes nothing
+    with pytest.raises(VersionConflict):
+        Completions.apply_result_delta(
+            task_pk, completion_id, [], ["a"], [], fields, version=1
+        )
+    with pytest.raises(VersionConflict):
+        Completions.set_honeypot(task_pk, completion_id, False, version=1)
+    db.session.expire_all()
+    (completion,) = Completions.get_completion(task_pk).completions
+    assert completion["version"] == 2
+    assert completion["honeypot"] is True
+    assert completion["result"] == [span("PER"), span("ORG", "b")]
+
+
+def counts(project_id):
+    db.session.expire_all()
+    counters = CompletionCounters.read(project_id)
+    return tuple(getattr(counters, name) for name in CompletionCounters.COUNTS)
+
+
+def test_counters_follow_writes(project):
+    project_id = project.project_id
+    assert counts(project_id) == (0, 0, 0)
+
+    # The first completion of a task is its ground truth
+    task_pk, completion_id = add_completion(
+        project,
+        {"result": [span("PER")], "submitted_at": "2020-07-18T06:17:12Z"},
+    )
+    assert counts(project_id) == (1, 1, 0)
+
+    Completions.set_review_status(
+        task_pk,
+        completion_id,
+        {
+            "approved": True,
+            "reviewer": "admin",
+            "reviewed_at": "2020-07-18T07:17:12Z",
+        },
+    )
+    assert counts(project_id) == (1, 1, 1)
+
+    add_completion(project, {"result": []})
+    assert counts(project_id) == (1, 1, 1)
+
+    # Recounting from Completions.completions agrees with the deltas
+    with db.engine.begin() as connection:
+        CompletionCounters.rebuild(connection, project_id)
+    assert counts(project_id) == (1, 1, 1)
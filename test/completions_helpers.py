@@ -0,0 +1,274 @@
+"""
+Unit tests for the pure completion helpers: no browser, no database
+"""
+import json
+from datetime import datetime, timezone
+import pytest
+from ai_project.helpers import completions as helpers
+from ai_project.helpers.completions import (
+    apply_labels_delta,
+    filter_copied_result,
+    iter_result_rows,
+    labels_delta,
+    stream_export,
+    stream_parallel_export,
+    validate_completion_data,
+)
+from ai_project.models.completions import (
+    CompiledLabelConfig,
+    CompletionsMeta,
+    OutputSchemaTuples,
+)
+
+PARSED_CONFIG = {
+    "label": {
+        "type": "Labels",
+        "to_name": ["text"],
+        "labels": ["PER", "ORG"],
+    },
+    "sentiment": {
+        "type": "Choices",
+        "to_name": ["text"],
+        "labels": ["positive", "negative"],
+    },
+}
+
+
+def span(label, start=0, end=4, **extra):
+    return {
+        "from_name": "label",
+        "to_name": "text",
+        "type": "labels",
+        "value": {"start": start, "end": end, "labels": [label]},
+        **extra,
+    }
+
+
+def test_labels_delta_subtracts_removed_labels():
+    added = {"label": {"PER": 2, "ORG": 1}, "sentiment": {"positive": 1}}
+    removed = {"label": {"PER": 1, "ORG": 1}, "sentiment": {"negative": 1}}
+    assert labels_delta(added, removed) == [
+        {"from_name": "label", "label": "PER", "count": 1},
+        {"from_name": "sentiment", "label": "negative", "count": -1},
+        {"from_name": "sentiment", "label": "positive", "count": 1},
+    ]
+
+
+def test_labels_delta_of_same_labels_is_empty():
+    info = {"label": {"PER": 3}}
+    assert labels_delta(info, info) == []
+
+
+def test_apply_labels_delta_increments_once(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        CompletionsMeta,
+        "increment_used_labels_info",
+        classmethod(lambda cls, *args: calls.append(args)),
+    )
+    apply_labels_delta(
+        1,
+        added=[{"result": [span("PER"), span("ORG")]}],
+        removed=[{"result": [span("PER")]}],
+    )
+    assert calls == [
+        (1, [{"from_name": "label", "label": "ORG", "count": 1}])
+    ]
+
+
+def test_output_schema_tuples_skip_relations():
+    relation = {"from_id": "a", "to_id": "b", "type": "relation"}
+    completions = [
+        {"result": [span("PER", id="a"), span("ORG", id="b"), relation]},
+        {"result": [span("PER")], "deleted_at": "2020-07-18T06:17:12Z"},
+    ]
+    assert OutputSchemaTuples.tuples_of(completions) == {
+        ("label", "text", "labels", "end:int,labels:list,start:int"): [
+            2,
+            {"start": 0, "end": 4, "labels": ["PER"]},
+        ]
+    }
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64 * 1024])
+def test_stream_export_json(monkeypatch, chunk_size):
+    monkeypatch.setattr(helpers, "EXPORT_CHUNK_SIZE", chunk_size)
+    records = [{"id": 1}, {"id": 2}, {"id": 3}]
+    chunks = list(stream_export(iter(records)))
+    assert json.loads("".join(chunks)) == records
+    if chunk_size == 1:
+        assert len(chunks) > 1
+
+
+def test_stream_export_jsonl():
+    records = [{"id": 1}, {"id": 2}]
+    lines = "".join(stream_export(iter(records), "jsonl")).splitlines()
+    assert [json.loads(line) for line in lines] == records
+
+
+def test_stream_export_empty():
+    assert json.loads("".join(stream_export(iter([])))) == []
+    assert "".join(stream_export(iter([]), "jsonl")) == ""
+
+
+def test_iter_result_rows_one_row_per_label():
+    record = {
+        "id": 7,
+        "completions": [
+            {
+                "id": 7001,
+                "created_username": "admin",
+                "honeypot": "true",
+                "submitted_at": "2020-07-18T06:17:12Z",
+                "result": [
+                    {
+                        "from_name": "label",
+                        "to_name": "text",
+                        "type": "labels",
+                        "value": {
+                            "start": 0,
+                            "end": "4",
+                            "labels": ["PER", "ORG"],
+                        },
+                    }
+                ],
+            }
+        ],
+        "predictions": [
+            {
+                "result": [
+                    {
+                        "from_name": "sentiment",
+                        "to_name": "text",
+                        "type": "choices",
+                        "value": {"choices": []},
+                    }
+                ]
+            }
+        ],
+    }
+    rows = list(iter_result_rows([record]))
+    assert [(row["source"], row["label"]) for row in rows] == [
+        ("completion", "PER"),
+        ("completion", "ORG"),
+        ("prediction", None),
+    ]
+    assert rows[0]["task_id"] == 7
+    assert rows[0]["completion_id"] == 7001
+    assert rows[0]["honeypot"] is True
+    assert rows[0]["submitted_at"] == datetime(
+        2020, 7, 18, 6, 17, 12, tzinfo=timezone.utc
+    )
+    assert (rows[0]["start"], rows[0]["end"]) == (0.0, 4.0)
+    assert rows[2]["honeypot"] is False
+    assert rows[2]["submitted_at"] is None
+
+
+def test_stream_parallel_export_skips_empty_shards():
+    shards = ['{"id": 1},{"id": 2}', "", '{"id": 3}']
+    assert json.loads("".join(stream_parallel_export(iter(shards)))) == [
+        {"id": 1},
+        {"id": 2},
+        {"id": 3},
+    ]
+    assert json.loads("".join(stream_parallel_export(iter(["", ""])))) == []
+
+
+def test_stream_parallel_export_jsonl():
+    shards = ['{"id": 1}\n', "", '{"id": 2}\n']
+    assert "".join(stream_parallel_export(iter(shards), "jsonl")) == (
+        '{"id": 1}\n{"id": 2}\n'
+    )
+
+
+def test_compiled_label_config_from_parsed():
+    config = CompiledLabelConfig.from_parsed(PARSED_CONFIG)
+    assert config.tuples == {
+        ("label", "text", "labels"),
+        ("sentiment", "text", "choices"),
+    }
+    assert config.labels["label"] == {"PER", "ORG"}
+
+
+def test_compiled_label_config_splits_assertion_labels():
+    config = CompiledLabelConfig.compile(
+        """
+        <View>
+          <Labels name="label" toName="text">
+            <Label value="PER"/>
+            <Label value="ABSENT" assertion="true"/>
+          </Labels>
+          <Text name="text" value="$text"/>
+        </View>
+        """
+    )
+    assert config.plain_labels == ("PER",)
+    assert config.assertion_labels == ("ABSENT",)
+
+
+@pytest.mark.parametrize(
+    "config", [PARSED_CONFIG, CompiledLabelConfig.from_parsed(PARSED_CONFIG)]
+)
+def test_validate_completion_data_accepts_valid_result(config):
+    completion = {"lead_time": 3, "result": [span("PER")]}
+    assert validate_completion_data(completion, config) is None
+
+
+@pytest.mark.parametrize(
+    "completion, error",
+    [
+        ({"lead_time": "3", "result": []}, "lead_time should be integer"),
+        ({}, "Missing/invalid 'result' format"),
+        (
+            {"result": [{"type": "labels", "value": {}}]},
+            "Missing from_name|to_name|type|value",
+        ),
+        (
+            {"result": [{**span("PER"), "to_name": "image"}]},
+            "from_name|to_name|type should be according to the defined "
+            "config",
+        ),
+        (
+            {"result": [span("PER", start="0")]},
+            "start/end indexes should be integer",
+        ),
+        ({"result": [span("LOC")]}, "Invalid labels: LOC"),
+    ],
+)
+def test_validate_completion_data_rejects(completion, error):
+    assert validate_completion_data(completion, PARSED_CONFIG) == error
+
+
+def test_validate_completion_data_skips_honeypot_toggle():
+    assert validate_completion_data({"honeypot": True}, PARSED_CONFIG) is None
+
+
+def test_filter_copied_result_keeps_items_in_range():
+    result = [
+        {"id": "a", "value": {"confidence": 0.9}},
+        {"id": "b", "value": {"confidence": 0.2}},
+        {"id": "c", "value": {"confidence": "0.5"}},
+    ]
+    kept = filter_copied_result(result, [0.5, 1], "prediction")
+    assert [item["id"] for item in kept] == ["a", "c"]
+
+
+def test_filter_copied_result_defaults_missing_confidence():
+    result = [{"id": "a", "value": {"start": 0}}]
+    completion = filter_copied_result(result, [0, 1], "completion")
+    prediction = filter_copied_result(result, [0, 1], "prediction")
+    assert completion[0]["value"]["confidence"] == 1
+    assert prediction[0]["value"]["confidence"] == 0
+    # The source item is left as it was
+    assert "confidence" not in result[0]["value"]
+
+
+def test_filter_copied_result_drops_dangling_relations():
+    result = [
+        {"id": "a", "value": {"confidence": 0.9}},
+        {"id": "b", "value": {"confidence": 0.1}},
+        {"from_id": "a", "to_id": "b", "direction": "right"},
+        {"from_id": "a", "to_id": "a", "direction": "right"},
+    ]
+    kept = filter_copied_result(result, [0.5, 1], "prediction")
+    assert kept == [result[0], result[3]]